@@ -1,21 +1,39 @@
+import argparse
 import shutil
 import tkinter
 from tkinter import filedialog
 from pathlib import Path
 import traceback
 
-from lib import loader, draw, config, paths
+from lib import loader, draw, config, paths, tiles, segmentation, export, timelapse, color
+from lib.journal import RunJournal
+from lib.layout import layout_key
+from lib.profiling import profiler
 from lib.paths import seek
 
 
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Generate a clade diagram from a Biogenesis world's backups.")
+    parser.add_argument("world", nargs="?", help="The world directory. A folder picker is shown if it's left out.")
+    parser.add_argument("--config", help="A config file applied over the world's config.ini. The run writes to "
+                                         "clade/runs/<config name>-<path hash> instead of clade/output, so runs with "
+                                         "different configs can render the same world at once and share its cache.")
+    return parser.parse_args()
+
+
 def main():
-    tk = tkinter.Tk()
-    tk.withdraw()
-    tk.iconbitmap("icon.ico")
+    args = parse_args()
 
-    path = filedialog.askdirectory()
-    if path == "":
-        return
+    if args.world is None:
+        tk = tkinter.Tk()
+        tk.withdraw()
+        tk.iconbitmap("icon.ico")
+
+        path = filedialog.askdirectory()
+        if path == "":
+            return
+    else:
+        path = args.world
     path = Path(path)
 
     # TODO: Remove this in 0.2.0
@@ -32,49 +50,119 @@ def main():
         print("Finished copying files from old directory.")
 
     config_path, config_created = paths.config_status(path)
-    if config_created:
+    if config_created and args.world is None:
         print(f"Created config.ini in {path.name}/clade. You may edit it now. (Be sure to save any changes.)")
         print("Press enter to continue when ready...")
         input()
-    config.update(config_path)
 
-    saves = loader.load_composites(path, verbose=True)
-    if not saves:
-        print("No world files detected!")
+    if args.config is None:
+        settings = config.load(config.DEFAULT, config_path)
+        output = paths.output(path)
+    else:
+        run_config = Path(args.config)
+        if not run_config.is_file():
+            raise FileNotFoundError(f"Config file {run_config} does not exist.")
+        settings = config.load(config.DEFAULT, config_path, run_config)
+        output = paths.output(path, run_config)
+    profiler.configure(settings.profile_enabled, settings.profile_memory, settings.profile_cprofile)
+
+    for cache in (paths.CACHE, paths.LAYOUT_CACHE):
+        paths.sweep(seek(path, cache))
+
+    # Two runs writing the same outputs would replace each other's files, so the second one waits for the first.
+    with paths.locked(output), color.palette_scope():
+        paths.sweep(output.parent)
+        paths.sweep(output)
+        generate(path, settings, output)
+
+
+def generate(path: Path, settings: config.Settings, output: Path):
+    # Outputs are replaced one by one as they are finished, and whatever this run didn't produce is only removed once
+    # it succeeds, so a stopped run leaves the previous diagram in place.
+    produced = []
+
+    interval = settings.clade_split_interval
+    budget = segmentation.pixel_budget(settings)
+    try:
+        if settings.output_mode == "export":
+            export_format = settings.export_format if settings.export_format != "none" else "csv"
+            produced.append(export.export_history(loader.iter_composites(path, settings, verbose=True), output,
+                                                  export_format))
+        else:
+            saves = loader.load_composites(path, settings, verbose=True)
+            if not saves:
+                print("No world files detected!")
+                input()
+                return
+
+            if settings.export_format != "none":
+                produced.append(export.export_history(saves, output, settings.export_format))
+
+            # Lay the whole range out once. Split images are viewports onto the same layout, so species columns line up
+            # between consecutive images and lineages keep their context across the cuts.
+            if (layout := loader.load_cached_layout(path, settings, saves)) is None:
+                layout = draw.CladeDiagram(saves, settings).layout
+                loader.cache_layout(path, layout, saves)
+
+            if settings.output_mode == "tiles":
+                tiles.render_tile_pyramid(layout, output / paths.TILES.name)
+                produced.append(output / paths.TILES.name)
+            elif settings.output_mode == "overview":
+                overview = output / f"clade-overview.{settings.file_type}"
+                layout.render_to_file(overview, scale=settings.overview_scale)
+                produced.append(overview)
+            elif settings.output_mode == "timelapse":
+                produced.append(timelapse.render_timelapse(layout, output, settings))
+            else:
+                if budget is not None:
+                    segments = segmentation.plan_segments(layout, budget)
+                    print(f"Splitting the clade into {len(segments)} images.")
+                elif interval != -1:
+                    segments = segmentation.interval_segments(len(saves), interval)
+                else:
+                    segments = [(0, len(saves))]
+
+                # Finished images are journaled, so a run stopped partway through a split diagram picks up at the first
+                # image it hadn't finished, as long as nothing that changes the images is different.
+                journal = RunJournal(output / paths.JOURNAL.name,
+                                     RunJournal.key_of(settings, layout_key(settings, saves)))
+                for i, (gstart, gend) in enumerate(segments):
+                    number = f"-{i + 1}" if budget is not None or interval != -1 else ""
+                    image = output / f"clade{number}.{settings.file_type}"
+                    produced.append(image)
+                    if journal.finished(image):
+                        print(f"Skipping {image.name}, which was finished by an earlier run.")
+                        continue
+                    layout.render_to_file(image, gstart, gend)
+                    journal.complete(image)
+                journal.finish()
+    except MemoryError:
+        if settings.output_mode == "export":
+            print("Ran out of memory! A single checkpoint is likely too large to be exported. Try exporting one "
+                  "lineage at a time with clade_focus in the config.")
+        elif budget is not None:
+            print("Ran out of memory! The clade diagram is likely too large to be rendered. Try setting "
+                  "clade_split_max_megapixels or clade_split_max_megabytes to a lower value in the config.")
+        else:
+            print(f"Ran out of memory! The clade diagram is likely too large to be rendered. Try setting "
+                  f"clade_split_interval{' to a lower value' if interval != -1 else ''} in the config.")
         input()
         return
 
-    start, end = (i if i != -1 else len(saves) for i in (config.clade_start, config.clade_end))
-    saves = saves[start - 1:end]
-
-    def generate_clade(gstart=0, glast=len(saves), gi=None):
-        if glast >= 0:
-            glast = min(glast, len(saves))
+    paths.prune(output, [p.name for p in produced])
 
-        clade = draw.CladeDiagram(saves[gstart:glast])
-        number = f"-{gi + 1}" if gi is not None else ""
-        clade.render_to_file(seek(path, paths.OUTPUT) / f"clade{number}.{config.file_type}")
+    dump_profile(path, settings)
 
-    paths.clear(seek(path, paths.OUTPUT))
 
-    interval = config.clade_split_interval
-    if interval != -1:
-        start = 0
-        last = len(saves)
-        for i, end in enumerate(range(start + interval, last + interval, interval)):
-            generate_clade(start, end, i)
-            start = end
-    else:
-        generate_clade()
+def dump_profile(path: Path, settings: config.Settings):
+    if profiler.enabled:
+        for profile_path in profiler.dump(seek(path, paths.PROFILE), settings.profile_format):
+            print(f"Saved profile to {profile_path.name}.")
 
 
 if __name__ == "__main__":
     try:
         main()
-    except MemoryError:
-        print(f"Ran out of memory! The clade diagram is likely too large to be rendered. Try setting "
-              f"clade_split_interval{' to a lower value' if config.clade_split_interval != -1 else ''} in the config.")
-        input()
     except Exception as exception:
         with open("log.txt", "w") as log_file:
             traceback.print_exception(exception, file=log_file)
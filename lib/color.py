@@ -1,19 +1,27 @@
 from __future__ import annotations
 
-import re
-from collections.abc import Iterable
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
 from functools import cached_property
 
 DECIMAL_RANGE = (2 ** 8) ** 3
 
+_CHANNELS = frozenset(range(256))
+_HEX_DIGITS = frozenset("0123456789abcdefABCDEF")
+_HEX_BYTES = tuple(f"{v:02X}" for v in range(256))
+
+
+def _int_to_tuple(val: int) -> tuple[int, int, int]:
+    return (val >> 16) & 0xFF, (val >> 8) & 0xFF, val & 0xFF
+
 
 def _raw_hex_to_tuple(h: str) -> tuple[int, int, int]:
     h = h.rjust(6, "0")
 
-    if len(h) != 6:
+    if len(h) != 6 or not _HEX_DIGITS.issuperset(h):
         raise ValueError()
 
-    return tuple(int(x, 16) for x in re.findall(r"..", h))
+    return _int_to_tuple(int(h, 16))
 
 
 class Color:
@@ -23,21 +31,20 @@ class Color:
                 if val < 0:
                     val += DECIMAL_RANGE
 
-                if val not in range(DECIMAL_RANGE):
+                if not 0 <= val < DECIMAL_RANGE:
                     raise ValueError()
 
-                val = _raw_hex_to_tuple(f"{val:x}")
+                val = _int_to_tuple(val)
 
             case str():
-                val = re.search(r"[\dA-F]{6}$", val, flags=re.IGNORECASE)
-                if not val:
+                if len(val) < 6:
                     raise ValueError()
-                val = _raw_hex_to_tuple(val.group())
+                val = _raw_hex_to_tuple(val[-6:])
 
             case Iterable():
                 val = tuple(val)
 
-                if len(val) != 3 or not all(isinstance(x, int) and x in range(256) for x in val):
+                if len(val) != 3 or not all(isinstance(x, int) and x in _CHANNELS for x in val):
                     raise ValueError()
 
             case _:
@@ -61,6 +68,9 @@ class Color:
 
         raise TypeError()
 
+    def __hash__(self):
+        return hash(self._rgb)
+
     @property
     def rgb(self) -> tuple[int, int, int]:
         return self._rgb
@@ -83,5 +93,50 @@ class Color:
 
     @cached_property
     def html(self) -> str:
-        colors = [f"{v:x}".rjust(2, "0").upper() for v in self.rgb]
-        return f"#{''.join(colors)}"
+        return f"#{''.join(_HEX_BYTES[v] for v in self.rgb)}"
+
+
+class Palette:
+    def __init__(self):
+        self._colors: list[Color] = []
+        self._indices: dict[tuple[int, int, int], int] = {}
+        self._values: dict = {}
+
+    def __len__(self):
+        return len(self._colors)
+
+    def __iter__(self):
+        return iter(self._colors)
+
+    def get(self, val) -> Color:
+        key = val if isinstance(val, (int, str, tuple)) else tuple(val)
+        if (color := self._values.get(key)) is not None:
+            return color
+
+        color = Color(key)
+        if (index := self._indices.get(color.rgb)) is not None:
+            color = self._colors[index]
+        else:
+            self._indices[color.rgb] = len(self._colors)
+            self._colors.append(color)
+
+        self._values[key] = color
+        return color
+
+
+_palettes: list[Palette] = [Palette()]
+
+
+def current_palette() -> Palette:
+    return _palettes[-1]
+
+
+@contextmanager
+def palette_scope() -> Iterator[Palette]:
+    # Colors interned during a run are dropped with it, so a process that runs several times doesn't keep every color
+    # it has ever seen.
+    _palettes.append(Palette())
+    try:
+        yield _palettes[-1]
+    finally:
+        _palettes.pop()
@@ -2,18 +2,30 @@ from __future__ import annotations
 
 from .datamodel import World, Organism, Clade
 
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .genomes import GenomeStore
+
 
 class Subspecies:
-    def __init__(self, data: Organism or dict):
+    def __init__(self, data: Organism or dict, genomes: GenomeStore or None = None):
         self._representative: Organism
         self._population: int
+        self._genome: str or None = None
+        self._genomes: GenomeStore or None = genomes
 
         if isinstance(data, Organism):
             self._representative = data
             self._population = 1
+        elif "genome" in data:
+            self._genome = data["genome"]
+            self._representative = genomes.organism(self._genome)
+            self._population = data["population"]
         else:
             self._representative = Organism(data["representative"])
             self._population = data["population"]
+            if genomes is not None:
+                self.intern(genomes)
 
     def __eq__(self, other):
         match other:
@@ -38,30 +50,45 @@ class Subspecies:
     def clade(self) -> Clade:
         return self.representative.clade
 
+    @property
+    def genome(self) -> str or None:
+        return self._genome
+
     def tally(self, count=1):
         self._population += count
 
+    def intern(self, genomes: GenomeStore):
+        self._genome, self._representative = genomes.intern(self._representative)
+        self._genomes = genomes
+
     def to_data_dict(self):
+        if self._genome is not None:
+            return {
+                "genome": self._genome,
+                "population": self.population
+            }
+
         return {
             "representative": self.representative.pack(),
             "population": self.population
         }
 
     def copy(self) -> Subspecies:
-        return Subspecies(self.to_data_dict())
+        return Subspecies(self.to_data_dict(), self._genomes)
 
 
 class Species:
-    def __init__(self, data: Clade or dict):
+    def __init__(self, data: Clade or dict, genomes: GenomeStore or None = None):
         self._clade: Clade
         self._subspecies: list[Subspecies]
+        self._genomes: GenomeStore or None = genomes
 
         if isinstance(data, Clade):
             self._clade = data
             self._subspecies = []
         else:
             self._clade = Clade(data["clade"])
-            self._subspecies = [Subspecies(sd) for sd in data["subspecies"]]
+            self._subspecies = [Subspecies(sd, genomes) for sd in data["subspecies"]]
 
     @property
     def subspecies(self) -> list[Subspecies]:
@@ -117,14 +144,24 @@ class Species:
             "subspecies": [s.to_data_dict() for s in self.subspecies]
         }
 
+    def intern(self, genomes: GenomeStore):
+        self._genomes = genomes
+        for subspecies in self._subspecies:
+            subspecies.intern(genomes)
+
     def copy(self) -> Species:
-        return Species(self.to_data_dict())
+        return Species(self.to_data_dict(), self._genomes)
+
+
+def in_focus(clade: Clade, focus: Clade or None) -> bool:
+    return focus is None or clade.is_direct_ancestor(focus)
 
 
 class SpeciesIndex:
-    def __init__(self, data: dict = None):
+    def __init__(self, data: dict = None, genomes: GenomeStore or None = None, focus: Clade or None = None):
         self._species: dict[str, Species]
-        self._species = {c: Species(s) for c, s in data.items()} if data is not None else {}
+        self._species = {c: Species(s, genomes) for c, s in data.items() if in_focus(Clade(c), focus)} \
+            if data is not None else {}
 
     @property
     def species(self) -> list[Species]:
@@ -157,30 +194,47 @@ class SpeciesIndex:
         species = self._species.setdefault(clade.string, Species(clade))
         species.log_subspecies(organism)
 
+    def intern(self, genomes: GenomeStore):
+        for species in self._species.values():
+            species.intern(genomes)
+
+    def focus(self, clade: Clade):
+        self._species = {c: s for c, s in self._species.items() if in_focus(s.clade, clade)}
+
     def to_data_dict(self) -> dict:
         return {c: s.to_data_dict() for c, s in self.dict.items()}
 
 
 class WorldComposite:
-    def __init__(self, data: World or dict):
+    def __init__(self, data: World or dict, genomes: GenomeStore or None = None, focus: Clade or None = None):
         self._species_index: SpeciesIndex
         self._time: int
         self.from_bgw: bool
+        self.fingerprint: str or None = None
 
         if isinstance(data, World):
             self.from_bgw = True
 
             self._species_index = SpeciesIndex()
-            for organism in data.organisms:
+            for organism in data.iter_organisms():
                 if not organism.alive:
                     continue
 
                 self._species_index.log_organism(organism)
             self._time = data.time
+
+            # Representatives are swapped for the store's shared organism once the tally is done, so every checkpoint
+            # that carries the same genome draws from one Organism and one segment tree.
+            if genomes is not None:
+                self._species_index.intern(genomes)
+
+            if focus is not None:
+                self.focus(focus)
         else:
             self.from_bgw = False
 
-            self._species_index = SpeciesIndex(data["species"])
+            # Species outside the focus are dropped before they are built, so their genomes are never looked up.
+            self._species_index = SpeciesIndex(data["species"], genomes, focus)
             self._time = data["time"]
 
     @property
@@ -195,6 +249,9 @@ class WorldComposite:
     def species(self) -> list[Species]:
         return self.species_index.species
 
+    def focus(self, clade: Clade):
+        self._species_index.focus(clade)
+
     def to_data_dict(self) -> dict:
         return {
             "time": self.time,
@@ -1,54 +1,92 @@
 from configparser import ConfigParser
+from dataclasses import dataclass, fields
+from pathlib import Path
 
 from .color import Color
 
 
-population_threshold: int
-extinction_dead_zone: int
+DEFAULT = Path("config.ini")
 
-edge_margin: int
-diagram_line_color: Color
-diagram_line_thickness: int
-node_padding: int
-node_min_radius: int
-species_margin: int
-species_min_width: int
-generation_margin: int
-generation_min_height: int
-generation_lines_enabled: bool
-generation_line_color: Color
-generation_line_thickness: int
 
-clade_start: int
-clade_end: int
-clade_split_interval: int
+@dataclass(frozen=True, slots=True)
+class Settings:
+    population_threshold: int
+    extinction_dead_zone: int
 
-file_type: str
+    edge_margin: int
+    diagram_line_color: Color
+    diagram_line_thickness: int
+    node_padding: int
+    node_min_radius: int
+    species_margin: int
+    species_min_width: int
+    generation_margin: int
+    generation_min_height: int
+    generation_lines_enabled: bool
+    generation_line_color: Color
+    generation_line_thickness: int
 
+    clade_start: int
+    clade_end: int
+    clade_focus: str
+    clade_split_interval: int
+    clade_split_max_megapixels: float
+    clade_split_max_megabytes: float
 
-config = ConfigParser()
+    file_type: str
+    output_mode: str
+    export_format: str
 
+    tile_size: int
 
-def update(path):
-    config.read(path)
+    detail_min_radius: int
+    overview_scale: float
 
-    for _, section in config.items():
-        for key in section.keys():
-            item_type = __annotations__[key]
-            if item_type is int:
-                value = section.getint(key)
-            elif item_type is float:
-                value = section.getfloat(key)
-            elif item_type is bool:
-                value = section.getboolean(key)
-            elif item_type is Color:
-                value = Color(section.get(key))
-            elif item_type is str:
-                value = section.get(key)
-            else:
-                raise NotImplementedError()
+    timelapse_format: str
+    timelapse_scale: float
+    timelapse_frame_duration: int
 
-            globals()[key] = value
+    prefetch_window: int
+    sampling_mode: str
+    sampling_interval: int
 
+    compression_level: int
+    palette_quantize: bool
+    encoder_threads: int
 
-update("config.ini")
+    profile_enabled: bool
+    profile_format: str
+    profile_memory: bool
+    profile_cprofile: str
+
+
+_TYPES = {f.name: f.type for f in fields(Settings)}
+
+
+def load(*paths) -> Settings:
+    # Each file overrides the ones before it key by key, so a key takes effect whichever section a later file puts it
+    # under.
+    values = {}
+    for path in paths:
+        config = ConfigParser()
+        config.read(path)
+
+        for _, section in config.items():
+            for key in section.keys():
+                item_type = _TYPES[key]
+                if item_type is int:
+                    value = section.getint(key)
+                elif item_type is float:
+                    value = section.getfloat(key)
+                elif item_type is bool:
+                    value = section.getboolean(key)
+                elif item_type is Color:
+                    value = Color(section.get(key))
+                elif item_type is str:
+                    value = section.get(key)
+                else:
+                    raise NotImplementedError()
+
+                values[key] = value
+
+    return Settings(**values)
@@ -5,8 +5,9 @@ import re
 from functools import cached_property
 import math
 import copy
+from collections.abc import Iterable, Iterator
 
-from .color import Color
+from .color import Color, current_palette
 from .segmenttree import SegmentTree
 
 PROPERTY_TYPES = [property, cached_property]
@@ -119,6 +120,26 @@ class World(DataContainer):
     def time(self) -> int:
         return self._get("worldStatistics", "time")
 
+    def iter_organisms(self) -> Iterator[Organism]:
+        return iter(self.organisms)
+
+
+class StreamedWorld(World):
+    def __init__(self, data, organisms: Iterable[dict]):
+        super().__init__(data)
+        self._stream: Iterator[dict] = iter(organisms)
+
+    @cached_property
+    def organisms(self) -> list[Organism]:
+        return list(self.iter_organisms())
+
+    def iter_organisms(self) -> Iterator[Organism]:
+        # The stream can only be walked once. Anything outside the organism list, such as the world's time, is
+        # filled into the data as the stream reaches it.
+        stream, self._stream = self._stream, iter(())
+        for organism in stream:
+            yield Organism(organism)
+
 
 class Organism(DataContainer):
     def __str__(self):
@@ -171,9 +192,31 @@ class Organism(DataContainer):
     def segment_tree(self) -> SegmentTree:
         return SegmentTree(self)
 
+    @cached_property
+    def dominant_color(self) -> Color or None:
+        # The color covering the most length, read from the genes alone so that no segment tree has to be built.
+        lengths = {}
+        for gene in self.genes:
+            lengths[gene.color] = lengths.get(gene.color, 0) + gene.length
+        return max(lengths, key=lengths.get, default=None)
+
     @property
     def radius(self) -> float:
-        return self.segment_tree.radius
+        # Genome records carry the radius and bounds, so laying out a cached organism never builds its segment tree.
+        try:
+            return self._get("radius")
+        except DataNotFound:
+            radius = self._data["radius"] = self.segment_tree.radius
+            return radius
+
+    @property
+    def bounds(self) -> tuple[float, float, float, float]:
+        try:
+            return tuple(self._get("bounds"))
+        except DataNotFound:
+            bounds = self.segment_tree.bounds
+            self._data["bounds"] = list(bounds)
+            return bounds
 
 
 class Gene(DataContainer):
@@ -213,14 +256,16 @@ class Gene(DataContainer):
             color_data = tuple(self._get("color", k) for k in ('r', 'g', 'b'))
         except DataNotFound:
             color_data = self._get("color", "value")
-        return Color(color_data)
+        return current_palette().get(color_data)
 
 
 class Clade:
     def __init__(self, clade_string: str):
         self._string: str = clade_string
 
-        base_id_string, lineage_string = re.match(r"^(?:.*:)?(\d+)([\s\S]*)$", self._string).groups()
+        match = re.match(r"^(?:.*:)?(\d+)([\s\S]*)$", self._string)
+        base_id_string, lineage_string = match.groups()
+        self._lineage_start: int = match.start(2)
         self._base_id: int = int(base_id_string)
         self._lineage: list[str] = re.findall(r"[\da-f]+", lineage_string)
 
@@ -251,6 +296,20 @@ class Clade:
     def lineage(self) -> list[str]:
         return self._lineage.copy()
 
+    @property
+    def depth(self) -> int:
+        return len(self._lineage)
+
+    @property
+    def parent(self) -> Clade or None:
+        if not self._lineage:
+            return None
+
+        # The string is cut just before the last lineage node, so the parent keeps whatever separators this one uses.
+        start = self._lineage_start
+        last = list(re.finditer(r"[\da-f]+", self._string[start:]))[-1]
+        return Clade(self._string[:start] + re.sub(r"[^\da-f]+$", "", self._string[start:start + last.start()]))
+
     def has_common_ancestor(self, other: Clade) -> bool:
         return self.base_id == other.base_id
 
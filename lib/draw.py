@@ -1,91 +1,63 @@
 from __future__ import annotations
 
-from PIL import ImageDraw, Image
-from pyglet.math import Vec2
+import math
 from typing import Generator
 from functools import cached_property
 
 from .datamodel import Organism, Clade
 from .composite import WorldComposite, Species
-from . import config
+from .config import Settings
+from .profiling import span
+from .render import Renderer
+from .layout import Layout
+from .lineage import LineageGraph
+from .population import PopulationMatrix
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    import numpy as np
 
 
 class NoGenerationsError(ValueError):
     pass
 
 
-class CladeDraw(ImageDraw.ImageDraw):
-    def organism(self, xy: tuple[int, int], organism: Organism):
-        for segment in organism.segment_tree.segments():
-            self.line(segment.xy(Vec2(*xy)), segment.color.rgb)
-
-    def connector(self, start: tuple[int, int], end: tuple[int, int], midrange: int):
-        xy = (
-            start,
-            (start[0], midrange),
-            (end[0], midrange),
-            end
-        )
-        self.line(xy, config.diagram_line_color.rgb, config.diagram_line_thickness)
-
-    def circle(self, xy: tuple[int, int], radius: float):
-        xy = (
-            (round(xy[0] - radius), round(xy[1] - radius)),
-            (round(xy[0] + radius), round(xy[1] + radius))
-        )
-        self.ellipse(xy, outline=config.diagram_line_color.rgb, fill=(0, 0, 0), width=config.diagram_line_thickness)
-
-
-def _aggregate_width(species: list[CladeSpecies]):
-    nodes = [s.node for s in species]
-    return sum(b.base_width_allocation() for b in nodes)
+class _RangeMax:
+    def __init__(self, size: int):
+        self._size: int = size
+        self._tree: list[float] = [-math.inf] * (2 * size)
+
+    def set(self, index: int, value: float):
+        tree = self._tree
+        index += self._size
+        tree[index] = value
+        while index > 1:
+            index //= 2
+            tree[index] = max(tree[2 * index], tree[2 * index + 1])
+
+    def max(self, first: int, last: int) -> float:
+        tree = self._tree
+        result = -math.inf
+        first += self._size
+        last += self._size + 1
+        while first < last:
+            if first & 1:
+                result = max(result, tree[first])
+                first += 1
+            if last & 1:
+                last -= 1
+                result = max(result, tree[last])
+            first //= 2
+            last //= 2
+        return result
 
 
 class DiagramNode:
     def __init__(self, species: CladeSpecies):
         self.cspecies: CladeSpecies = species
+        self.settings: Settings = species.settings
 
-        self._x = None
-
-    @cached_property
-    def x(self) -> int:
-        positions = []
-
-        if (previous := self.previous()) is not None:
-            positions.append(self._x_from(previous))
-
-            own_child_count = self.cspecies.child_generation_count()
-            nodes = []
-            for species in self.cspecies.before():
-                if config.extinction_dead_zone != -1:
-                    generator = species.child_generations(own_child_count + config.extinction_dead_zone)
-                else:
-                    generator = species.child_generations()
-                for generation in generator:
-                    nodes.append(generation[-1].node)
-
-            if nodes:
-                node = max(nodes, key=lambda b: b.x)
-                positions.append(self._x_from(node))
-
-            # if (previous_parent := previous.cspecies.get_parent()) is not None \
-            # and self.cspecies.get_parent() is not previous_parent:
-            #     positions.append(previous_parent.diagram_element.x() + CONNECTOR_MARGIN)
-
-            # previous_descendants_bubbles = [cg[-1].diagram_element for cg in previous.cspecies.child_generations()]
-            # if previous_descendants_bubbles:
-            #     bubble = max(previous_descendants_bubbles, key=lambda b: b.x())
-            #     positions.append(self._x_from(bubble))
-        else:
-            positions.append(config.edge_margin + self.radius)
-
-        if (parent := self.cspecies.parent) is not None:
-            positions.append(parent.node.x)
-
-        return max(positions)
-
-    def initialize_x(self) -> int:
-        return self.x
+        self.x: int or None = None
 
     @cached_property
     def y(self) -> int:
@@ -95,9 +67,10 @@ class DiagramNode:
     def organism(self) -> Organism:
         return self.cspecies.species.representative
 
-    @property
+    @cached_property
     def radius(self) -> int:
-        return max(round(self.organism.radius) + config.node_padding, config.node_min_radius)
+        settings = self.settings
+        return max(round(self.organism.radius) + settings.node_padding, settings.node_min_radius)
 
     @property
     def diameter(self) -> int:
@@ -125,49 +98,20 @@ class DiagramNode:
         return None
 
     def base_width_allocation(self) -> int:
-        return max(self.diameter + config.species_margin, config.species_min_width)
-
-    @cached_property
-    def _column_radius(self):
-        radii = [self.radius]
-        radii += [cg[0].node.radius for cg in self.cspecies.child_generations()]
-        return max(radii)
-
-    def _x_from(self, other: DiagramNode):
-        return other.x + other.base_width_allocation() - other.radius + self._column_radius
-
-    def draw(self, surface: CladeDraw):
-        species = self.cspecies
-        representative = species.representative
-        if len(children := species.get_children()) == 1 \
-        and (parent := species.parent) is not None \
-        and len(parent.get_children()) == 1 \
-        and representative == parent.representative \
-        and representative == children[0].representative:
-            surface.connector(self.bottom, self.top, self.y)
-            return
+        settings = self.settings
+        return max(self.diameter + settings.species_margin, settings.species_min_width)
 
-        surface.circle(self.xy, self.radius)
-        surface.organism(self.xy, self.cspecies.representative)
-
-    def draw_connector(self, surface: CladeDraw, to: DiagramNode):
-        midrange = self.cspecies.generation.midpoint(to.cspecies.generation)
-        surface.connector(self.top, to.bottom, midrange)
+    def right_edge(self) -> int:
+        return self.x - self.radius + self.base_width_allocation()
 
 
 class CladeSpecies:
     def __init__(self, generation: CladeGeneration, species: Species):
         self.generation: CladeGeneration = generation
         self.species: Species = species
+        self.settings: Settings = generation.settings
         self.node = DiagramNode(self)
-
-        self._children: list[CladeSpecies] or None
-        self._child_generation_count: int or None
-        self._reset_cache()
-
-    def _reset_cache(self):
-        self._children = None
-        self._child_generation_count = None
+        self.id: int or None = None
 
     @property
     def clade(self) -> Clade:
@@ -181,8 +125,12 @@ class CladeSpecies:
     def population(self) -> int:
         return self.species.population
 
+    @property
+    def graph(self) -> LineageGraph:
+        return self.generation.diagram.graph
+
     def get_index(self) -> int:
-        return self.generation.species.index(self)
+        return self.generation.index_of(self)
 
     def before(self) -> list[CladeSpecies]:
         return self.generation.species[:self.get_index()]
@@ -202,140 +150,113 @@ class CladeSpecies:
 
         return None
 
-    @cached_property
+    @property
     def parent(self) -> CladeSpecies or None:
-        if (previous_generation := self.generation.previous()) is None:
+        if (parent := self.graph.parent(self.id)) == -1:
             return None
 
-        candidates = [s for s in previous_generation.species if self.clade.is_direct_ancestor(s.clade)]
-
-        if not candidates:
-            return None
-
-        candidates.sort(key=lambda s: self.clade.distance_from(s.clade))
-
-        return candidates[0]
+        return self.generation.diagram.species_by_id[parent]
 
     def get_children(self) -> list[CladeSpecies]:
-        if (children := self._children) is not None:
-            return children
-
-        if (next_generation := self.generation.next()) is None:
-            return []
-
-        self._children = [s for s in next_generation.species if s.parent is self]
-        return self._children
-
-    def child_generations(self, stop: int or None = None) -> Generator[list[CladeSpecies]]:
-        generation = [self]
-        i = 0
-        while True:
-            if i == stop:
-                break
-
-            next_generation = []
-            for species in generation:
-                next_generation += species.get_children()
-            generation = next_generation
-
-            if not generation:
-                break
-
-            yield generation
-
-            i += 1
+        species = self.generation.diagram.species_by_id
+        return [species[c] for c in self.graph.children[self.id]]
 
     def child_generation_count(self) -> int:
-        if (count := self._child_generation_count) is not None:
-            return count
-
-        self._child_generation_count = len(list(self.child_generations()))
-        return self._child_generation_count
+        return self.graph.height(self.id)
 
     def should_include(self) -> bool:
-        if self.population >= config.population_threshold:
-            return True
-
-        if (parent := self.parent) is not None:
-            if parent.clade == self.clade and parent.should_include():
-                return True
-
-        for generation in self.child_generations():
-            if sum(s.population for s in generation) >= config.population_threshold:
-                return True
-
-        return False
+        return bool(self.generation.diagram.included[self.id])
 
 
 def _sorted_by_child_count(l: list[CladeSpecies]):
-    l = sorted(l, key=lambda s: s.child_generation_count())
-    return l[-1:] + l[:-1]
+    # The longest-lived sibling stays directly above its parent and the rest follow from longest to shortest, so each
+    # later sibling only has to clear the others for as long as it lives, and the staircase they form leaves the
+    # columns of short-lived lineages free for whatever comes next.
+    return sorted(l, key=lambda s: s.child_generation_count(), reverse=True)
 
 
 class CladeGeneration:
     def __init__(self, diagram: CladeDiagram, species: list[Species]):
         self.diagram: CladeDiagram = diagram
+        self.settings: Settings = diagram.settings
 
-        self.species: list[CladeSpecies] = [CladeSpecies(self, s) for s in species]
+        self.index: int or None = None
+        self._species: list[CladeSpecies] = [CladeSpecies(self, s) for s in species]
+        self._positions: dict[int, int] or None = None
 
-    def _reset_cache(self):
-        for species in self.species:
-            species._reset_cache()
-
-    def _post_update1(self):
-        self.species = [s for s in self.species if s.should_include()]
+    @property
+    def species(self) -> list[CladeSpecies]:
+        return self._species
+
+    @species.setter
+    def species(self, species: list[CladeSpecies]):
+        self._species = species
+        self._positions = None
+        self.diagram._spans_after = None
+
+    def index_of(self, species: CladeSpecies) -> int:
+        if (positions := self._positions) is None:
+            positions = self._positions = {id(s): i for i, s in enumerate(self._species)}
+        return positions[id(species)]
+
+    def _post_update1(self) -> list[CladeSpecies]:
+        included = [s.should_include() for s in self.species]
+        removed = [s for s, keep in zip(self.species, included) if not keep]
+        self.species = [s for s, keep in zip(self.species, included) if keep]
+        return removed
 
     def _post_update2(self):
-        # TODO: More advanced space optimization
-
         updated_species = []
 
         if (previous_generation := self.previous()) is not None:
             for species in previous_generation.species:
                 updated_species += _sorted_by_child_count(species.get_children())
 
-        updated_species += sorted([s for s in self.species if s not in updated_species], key=lambda s: s.clade.string)
+        placed = {id(s) for s in updated_species}
+        updated_species += sorted([s for s in self.species if id(s) not in placed], key=lambda s: s.clade.string)
 
         self.species = updated_species
 
     def add_species(self, species: CladeSpecies):
-        self.species.append(species)
+        self.species = self.species + [species]
 
     def get_index(self):
-        for i, generation in enumerate(self.diagram.generations):
-            if generation is self:
-                return i
+        return self.index
 
     def after(self) -> list[CladeGeneration]:
-        return self.diagram.generations[self.get_index() + 1:]
+        return self.diagram.generations[self.index + 1:]
 
     def before(self) -> list[CladeGeneration]:
-        return self.diagram.generations[:self.get_index()]
+        return self.diagram.generations[:self.index]
 
     def next(self) -> CladeGeneration or None:
-        after = self.after()
-        return after[0] if after else None
+        generations = self.diagram.generations
+        return generations[self.index + 1] if self.index + 1 < len(generations) else None
 
     def previous(self) -> CladeGeneration or None:
-        before = self.before()
-        return before[-1] if before else None
+        return self.diagram.generations[self.index - 1] if self.index > 0 else None
 
     def height(self) -> int:
         if not self.species:
-            return config.node_min_radius * 2
+            return self.settings.node_min_radius * 2
 
         return max(s.node.diameter for s in self.species)
 
     def width(self) -> int:
+        settings = self.settings
         if not self.species:
-            return config.node_min_radius * 2 + config.edge_margin * 2
+            return settings.node_min_radius * 2 + settings.edge_margin * 2
 
         last_node = self.species[-1].node
-        return last_node.x + last_node.radius + config.edge_margin
+        return last_node.x + last_node.radius + settings.edge_margin
+
+    def row_span(self) -> int:
+        settings = self.settings
+        return max(self.height() + settings.generation_margin, settings.generation_min_height)
 
     def y_pos(self) -> int:
-        y = config.edge_margin
-        y += sum(max(g.height() + config.generation_margin, config.generation_min_height) for g in self.after())
+        y = self.settings.edge_margin
+        y += self.diagram.spans_after(self.index)
         y += self.height() / 2
         return y
 
@@ -345,82 +266,132 @@ class CladeGeneration:
 
 
 class CladeDiagram:
-    def __init__(self, generation_worlds: list[WorldComposite]):
+    def __init__(self, generation_worlds: list[WorldComposite], settings: Settings,
+                 population: PopulationMatrix or None = None):
         if not generation_worlds:
             raise NoGenerationsError()
 
+        self.settings: Settings = settings
+        self._spans_after: list[int] or None = None
+
+        if population is None:
+            with span("population"):
+                population = PopulationMatrix.from_composites(generation_worlds)
+        self.population: PopulationMatrix = population
+        self.included: np.ndarray or None = None
+
         print("Initializing clade...")
-        self.generations: list[CladeGeneration] = [CladeGeneration(self, w.species) for w in generation_worlds]
+        self.generations: list[CladeGeneration] = []
+        for world in generation_worlds:
+            self.add_generation(CladeGeneration(self, world.species))
+
+        # Every structural query reads from one lineage graph, built once. Pruning removes nodes from it and sorting
+        # replays the final species order into its child lists.
+        self.species_by_id: list[CladeSpecies] = [s for g in self.generations for s in g.species]
+        for i, species in enumerate(self.species_by_id):
+            species.id = i
+        self.graph: LineageGraph = LineageGraph([[s.clade for s in g.species] for g in self.generations])
+
+        # The threshold test for the whole history runs over the population matrix at once. A species is kept if it,
+        # or all of its descendants in any one later generation together, reach the threshold, or if its clade was
+        # kept a generation earlier.
+        with span("pruning", generations=len(self.generations)):
+            self.included = population.included(self.graph.parents, settings.population_threshold)
+
+            removed = []
+            for generation in self.generations:
+                removed += generation._post_update1()
+            self.graph.remove([s.id for s in removed])
 
-        for generation in self.generations:
-            generation._post_update1()
-        self._reset_cache()
-        for generation in self.generations:
-            generation._post_update2()
-        self._reset_cache()
+        with span("sorting"):
+            for generation in self.generations:
+                generation._post_update2()
+            self.graph.reorder([s.id for g in self.generations for s in g.species])
 
-        for node in self.nodes():
-            node.initialize_x()
+        with span("x_layout"):
+            self._layout_x()
 
         print("Completed clade diagram initialization.")
 
-    def _reset_cache(self):
-        for generation in self.generations:
-            generation._reset_cache()
-
     def add_generation(self, generation: CladeGeneration):
+        generation.index = len(self.generations)
         self.generations.append(generation)
+        self._spans_after = None
+
+    def _layout_x(self):
+        # Nodes are placed depth first, so each generation fills in from left to right. A node has to clear whatever
+        # was last placed in its own generation and in every generation its lineage lives through, plus the dead
+        # zone. A range maximum over each generation's right edge answers that without walking anyone's descendants,
+        # and generations where earlier lineages have already died out don't hold it back.
+        settings = self.settings
+        dead_zone = settings.extinction_dead_zone
+        count = len(self.generations)
+        edges = _RangeMax(count)
+        started = [False] * count
+
+        # A column has to be wide enough for the lineage stacked above it, which follows the deepest, first children.
+        children = self.graph.children
+        column_radii = [0] * len(self.species_by_id)
+        for generation in reversed(self.generations):
+            for species in generation.species:
+                radius = species.node.radius
+                if first := children[species.id][:1]:
+                    radius = max(radius, column_radii[first[0]])
+                column_radii[species.id] = radius
 
-    @cached_property
+        for node in self.nodes():
+            species = node.cspecies
+            row = species.generation.index
+
+            if not started[row]:
+                x = settings.edge_margin + node.radius
+            else:
+                last = count - 1 if dead_zone == -1 \
+                    else min(row + species.child_generation_count() + dead_zone, count - 1)
+                x = edges.max(row, last) + column_radii[species.id]
+
+            if (parent := species.parent) is not None:
+                x = max(x, parent.node.x)
+
+            node.x = x
+            edges.set(row, node.right_edge())
+            started[row] = True
+
+    def spans_after(self, index: int) -> int:
+        if (spans := self._spans_after) is None:
+            spans = [0] * len(self.generations)
+            for i in range(len(self.generations) - 2, -1, -1):
+                spans[i] = spans[i + 1] + self.generations[i + 1].row_span()
+            self._spans_after = spans
+        return spans[index]
+
+    @property
     def width(self) -> int:
-        return max(g.width() for g in self.generations)
+        return self.layout.size()[0]
 
-    @cached_property
+    @property
     def height(self) -> int:
-        height = sum(max(g.height() + config.generation_margin, config.generation_min_height)
-                     for g in self.generations[:-1])
-        height += self.generations[-1].height()
-        height += config.edge_margin * 2
-        return height
+        return self.layout.size()[1]
 
     def nodes(self) -> Generator[DiagramNode]:
-        species_queue = []
-        for generation in self.generations:
-            species_queue += [s for s in generation.species if s.parent is None]
+        species = self.species_by_id
+        children = self.graph.children
 
-            while species_queue:
-                species = species_queue.pop(0)
-                yield species.node
-                species_queue = species.get_children() + species_queue
-
-    def render_to_file(self, path):
-        print("Initializing image...")
-        image = Image.new("RGB", (self.width, self.height), (0, 0, 0))
-        draw = CladeDraw(image)
-
-        if config.generation_lines_enabled:
-            print("Drawing generation lines...")
-            for generation in self.generations:
-                y = generation.y_pos()
-                draw.line((0, y, self.width, y), config.generation_line_color.rgb, config.generation_line_thickness)
-
-        nodes = list(self.nodes())
-        nodes_count = len(nodes)
-
-        print("Drawing diagram connectors...")
-        for i, node in enumerate(nodes):
-            if i % 100 == 0:
-                print(f"Drawing connectors... ({i}/{nodes_count})")
+        # Each root's lineage is walked depth first, children in their sorted order, before the next root.
+        for generation in self.generations:
+            stack = [s.id for s in reversed(generation.species) if s.parent is None]
 
-            for child in node.cspecies.get_children():
-                node.draw_connector(draw, child.node)
+            while stack:
+                node = stack.pop()
+                yield species[node].node
+                stack += reversed(children[node])
 
-        print("Drawing species nodes...")
-        for i, node in enumerate(nodes):
-            if i % 100 == 0:
-                print(f"Drawing organisms... ({i}/{nodes_count})")
+    @cached_property
+    def layout(self) -> Layout:
+        return Layout.from_diagram(self)
 
-            node.draw(draw)
+    def render(self, renderer: Renderer):
+        self.layout.render(renderer)
 
-        print(f"Writing {path.name}...")
-        image.save(path)
+    def render_to_file(self, path):
+        self.layout.render_to_file(path)
@@ -0,0 +1,399 @@
+from __future__ import annotations
+
+import io
+import math
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+from PIL import Image
+
+from .config import Settings
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+PALETTE_FORMATS = {"png", "gif", "bmp", "tif", "tiff"}
+
+STRIP_HEIGHT = 512
+
+_WINDOW = 32768
+
+
+def palette_for(colors: set[tuple[int, int, int]]) -> list[tuple[int, int, int]] or None:
+    if len(colors | {(0, 0, 0)}) > 256:
+        return None
+
+    # The background is always index 0, so a fresh paletted image starts out black.
+    return [(0, 0, 0)] + sorted(colors - {(0, 0, 0)})
+
+
+def new_image(size: tuple[int, int], palette: list[tuple[int, int, int]] or None) -> Image.Image:
+    if palette is None:
+        return Image.new("RGB", size, (0, 0, 0))
+
+    image = Image.new("P", size, 0)
+    image.putpalette(bytes(v for rgb in palette for v in rgb))
+    return image
+
+
+def uses_palette(path: Path, settings: Settings) -> bool:
+    return settings.palette_quantize and path.suffix.lstrip(".").lower() in PALETTE_FORMATS
+
+
+def save_image(image: Image.Image, path: Path, settings: Settings):
+    path = Path(path)
+
+    if image.mode == "RGB" and uses_palette(path, settings) \
+            and (colors := image.getcolors(256)) is not None:
+        palette = new_image((1, 1), palette_for({rgb for _, rgb in colors}))
+        image = image.quantize(palette=palette, dither=Image.Dither.NONE)
+
+    options = {}
+    if path.suffix.lower() == ".png" and settings.compression_level != -1:
+        options["compress_level"] = settings.compression_level
+
+    image.save(path, **options)
+
+
+def encoder_threads(settings: Settings) -> int:
+    if settings.encoder_threads == -1:
+        return os.cpu_count() or 1
+    return settings.encoder_threads
+
+
+def _bit_depth(palette: list[tuple[int, int, int]] or None) -> int:
+    if palette is None:
+        return 8
+    for bits in (1, 2, 4):
+        if len(palette) <= 1 << bits:
+            return bits
+    return 8
+
+
+def _raw_format(palette: list[tuple[int, int, int]] or None, width: int) -> tuple[str, int]:
+    bits = _bit_depth(palette)
+    if palette is None:
+        return "RGB", width * 3
+    return "P" if bits == 8 else f"P;{bits}", math.ceil(width * bits / 8)
+
+
+def _filter_rows(data: bytes, stride: int, previous: bytes or None) -> tuple[bytes, bytes or None]:
+    # Most rows are either unfiltered or an exact repeat of the row above, which the Up filter turns into zeros.
+    repeat = b"\x02" + bytes(stride)
+    filtered = []
+    for i in range(0, len(data), stride):
+        row = data[i:i + stride]
+        filtered.append(repeat if row == previous else b"\x00" + row)
+        previous = row
+    return b"".join(filtered), previous
+
+
+def _chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(data, zlib.crc32(kind)))
+
+
+def _zlib_header(level: int) -> bytes:
+    if level == -1 or level == 6:
+        return b"\x78\x9c"
+    if level >= 7:
+        return b"\x78\xda"
+    if level >= 2:
+        return b"\x78\x5e"
+    return b"\x78\x01"
+
+
+def _deflate(raw: bytes, level: int, zdict: bytes, final: bool) -> bytes:
+    # Each strip is a raw deflate stream primed with the tail of the previous strip, so the streams can simply be
+    # concatenated: every strip but the last ends on a byte-aligned sync flush instead of a final block.
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(raw) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class PngStripWriter:
+    def __init__(self, path: Path, size: tuple[int, int], palette: list[tuple[int, int, int]] or None,
+                 settings: Settings):
+        self.path: Path = Path(path)
+        self.size: tuple[int, int] = size
+        self.bytes_written: int = 0
+
+        self._level: int = settings.compression_level
+        self._bits: int = _bit_depth(palette)
+        self._rawmode, self._stride = _raw_format(palette, size[0])
+        self._rows: int = 0
+        self._adler: int = 1
+        self._tail: bytes = b""
+        self._previous: bytes or None = None
+
+        threads = encoder_threads(settings)
+        self._pool: ThreadPoolExecutor = ThreadPoolExecutor(threads, thread_name_prefix="png")
+        self._pending: deque[Future] = deque()
+        self._window: int = threads * 2
+
+        self._file = open(self.path, "wb")
+        self._write(PNG_SIGNATURE)
+        color_type = 2 if palette is None else 3
+        self._write(_chunk(b"IHDR", struct.pack(">IIBBBBB", size[0], size[1], self._bits, color_type, 0, 0, 0)))
+        if palette is not None:
+            self._write(_chunk(b"PLTE", bytes(v for rgb in palette for v in rgb)))
+        self._header: bytes = _zlib_header(self._level)
+
+    def __enter__(self) -> PngStripWriter:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.finish()
+        finally:
+            self.close()
+
+    def _write(self, data: bytes):
+        self._file.write(data)
+        self.bytes_written += len(data)
+
+    def _write_idat(self, data: bytes):
+        if self._header:
+            data = self._header + data
+            self._header = b""
+        self._write(_chunk(b"IDAT", data))
+
+    def write(self, image: Image.Image):
+        data = image.tobytes("raw", self._rawmode)
+        rows = len(data) // self._stride
+        raw, self._previous = _filter_rows(data, self._stride, self._previous)
+
+        self._rows += rows
+        final = self._rows >= self.size[1]
+        self._pending.append(self._pool.submit(_deflate, raw, self._level, self._tail, final))
+
+        self._adler = zlib.adler32(raw, self._adler)
+        self._tail = raw[-_WINDOW:]
+
+        while len(self._pending) > self._window:
+            self._write_idat(self._pending.popleft().result())
+
+    def finish(self):
+        if self._rows != self.size[1]:
+            raise ValueError(f"Expected {self.size[1]} rows, got {self._rows}.")
+
+        while self._pending:
+            self._write_idat(self._pending.popleft().result())
+        self._write(_chunk(b"IDAT", struct.pack(">I", self._adler)))
+        self._write(_chunk(b"IEND", b""))
+
+    def close(self):
+        self._pool.shutdown(cancel_futures=True)
+        self._file.close()
+
+
+class _FrameWriter:
+    def __init__(self, size: tuple[int, int], frame_count: int, duration: int, settings: Settings):
+        self.size: tuple[int, int] = size
+        self.frame_count: int = frame_count
+        self.duration: int = duration
+
+        self._settings: Settings = settings
+        self._frames: int = 0
+
+        # Frames are encoded on the pool while the next ones are drawn, and are emitted in order.
+        threads = max(encoder_threads(settings), 1)
+        self._pool: ThreadPoolExecutor = ThreadPoolExecutor(threads, thread_name_prefix="frames")
+        self._pending: deque[Future] = deque()
+        self._window: int = threads * 2
+
+    def __enter__(self) -> _FrameWriter:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.finish()
+        finally:
+            self.close()
+
+    def _encode(self, image: Image.Image, box: tuple[int, int], index: int):
+        raise NotImplementedError()
+
+    def _emit(self, encoded, image: Image.Image, box: tuple[int, int], index: int):
+        pass
+
+    def _end(self):
+        pass
+
+    def write(self, image: Image.Image, box: tuple[int, int] = (0, 0)):
+        # The image only has to cover what changed since the previous frame, placed at box. It is encoded in the
+        # background, so it must not be drawn on afterwards.
+        index = self._frames
+        self._pending.append((self._pool.submit(self._encode, image, box, index), image, box, index))
+        self._frames += 1
+
+        while len(self._pending) > self._window:
+            self._emit_next()
+
+    def _emit_next(self):
+        future, image, box, index = self._pending.popleft()
+        self._emit(future.result(), image, box, index)
+
+    def finish(self):
+        if self._frames != self.frame_count:
+            raise ValueError(f"Expected {self.frame_count} frames, got {self._frames}.")
+
+        while self._pending:
+            self._emit_next()
+        self._end()
+
+    def close(self):
+        self._pool.shutdown(cancel_futures=True)
+
+
+class FrameFileWriter(_FrameWriter):
+    def __init__(self, directory: Path, file_type: str, size: tuple[int, int], frame_count: int, duration: int,
+                 settings: Settings):
+        super().__init__(size, frame_count, duration, settings)
+        self.directory: Path = Path(directory)
+        self.file_type: str = file_type
+
+        self._digits: int = len(str(frame_count))
+
+    def path(self, index: int) -> Path:
+        return self.directory / f"frame-{index + 1:0{self._digits}d}.{self.file_type}"
+
+    def write(self, image: Image.Image, box: tuple[int, int] = (0, 0)):
+        if image.size != self.size or box != (0, 0):
+            raise ValueError("Frame files have to cover the whole image.")
+        super().write(image, box)
+
+    def _encode(self, image: Image.Image, box: tuple[int, int], index: int):
+        save_image(image, self.path(index), self._settings)
+
+
+class ApngWriter(_FrameWriter):
+    def __init__(self, path: Path, size: tuple[int, int], palette: list[tuple[int, int, int]] or None,
+                 frame_count: int, duration: int, settings: Settings):
+        super().__init__(size, frame_count, duration, settings)
+        self.path: Path = Path(path)
+        self.bytes_written: int = 0
+
+        self._palette: list[tuple[int, int, int]] or None = palette
+        self._level: int = settings.compression_level
+        self._sequence: int = 0
+
+        self._file = open(self.path, "wb")
+        self._write(PNG_SIGNATURE)
+        color_type = 2 if palette is None else 3
+        self._write(_chunk(b"IHDR", struct.pack(">IIBBBBB", size[0], size[1], _bit_depth(palette), color_type,
+                                                0, 0, 0)))
+        if palette is not None:
+            self._write(_chunk(b"PLTE", bytes(v for rgb in palette for v in rgb)))
+        self._write(_chunk(b"acTL", struct.pack(">II", frame_count, 0)))
+
+    def _write(self, data: bytes):
+        self._file.write(data)
+        self.bytes_written += len(data)
+
+    def write(self, image: Image.Image, box: tuple[int, int] = (0, 0)):
+        if self._frames == 0 and (image.size != self.size or box != (0, 0)):
+            raise ValueError("The first frame has to cover the whole image.")
+        super().write(image, box)
+
+    def _encode(self, image: Image.Image, box: tuple[int, int], index: int) -> bytes:
+        rawmode, stride = _raw_format(self._palette, image.width)
+        raw, _ = _filter_rows(image.tobytes("raw", rawmode), stride, None)
+        return zlib.compress(raw, self._level)
+
+    def _emit(self, encoded: bytes, image: Image.Image, box: tuple[int, int], index: int):
+        # Each frame is laid over the previous one, which is never disposed of. The first frame doubles as the still
+        # image shown by viewers without APNG support.
+        self._write(_chunk(b"fcTL", struct.pack(">IIIIIHHBB", self._sequence, *image.size, *box, self.duration, 1000,
+                                                0, 0)))
+        self._sequence += 1
+
+        if index == 0:
+            self._write(_chunk(b"IDAT", encoded))
+        else:
+            self._write(_chunk(b"fdAT", struct.pack(">I", self._sequence) + encoded))
+            self._sequence += 1
+
+    def _end(self):
+        self._write(_chunk(b"IEND", b""))
+
+    def close(self):
+        super().close()
+        self._file.close()
+
+
+def _gif_frame(image: Image.Image, box: tuple[int, int], delay: int) -> bytes:
+    # Pillow encodes the frame on its own, then its image block is lifted out and placed at box. Whatever color table
+    # Pillow chose becomes the frame's local table, so frames don't have to agree on one.
+    buffer = io.BytesIO()
+    image.save(buffer, "GIF", optimize=False, interlace=False)
+    data = buffer.getvalue()
+
+    pos = 13
+    table = b""
+    table_bits = 0
+    if (packed := data[10]) & 0x80:
+        table_bits = packed & 0x07
+        table = data[pos:pos + (3 << (table_bits + 1))]
+        pos += len(table)
+
+    while data[pos] == 0x21:
+        pos += 2
+        while data[pos]:
+            pos += data[pos] + 1
+        pos += 1
+
+    if data[pos] != 0x2C:
+        raise ValueError("Unexpected block in encoded gif frame.")
+
+    descriptor = bytearray(data[pos:pos + 10])
+    pos += 10
+    struct.pack_into("<HH", descriptor, 1, *box)
+    if descriptor[9] & 0x80:
+        table = data[pos:pos + (3 << ((descriptor[9] & 0x07) + 1))]
+        pos += len(table)
+    else:
+        descriptor[9] |= 0x80 | table_bits
+
+    end = pos + 1
+    while data[end]:
+        end += data[end] + 1
+    end += 1
+
+    control = b"\x21\xf9\x04\x04" + struct.pack("<H", delay) + b"\x00\x00"
+    return control + bytes(descriptor) + table + data[pos:end]
+
+
+class GifWriter(_FrameWriter):
+    def __init__(self, path: Path, size: tuple[int, int], frame_count: int, duration: int, settings: Settings):
+        super().__init__(size, frame_count, duration, settings)
+        self.path: Path = Path(path)
+        self.bytes_written: int = 0
+
+        self._file = open(self.path, "wb")
+        self._write(b"GIF89a" + struct.pack("<HHBBB", *size, 0x70, 0, 0))
+        self._write(b"\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00")
+
+    def _write(self, data: bytes):
+        self._file.write(data)
+        self.bytes_written += len(data)
+
+    def _encode(self, image: Image.Image, box: tuple[int, int], index: int) -> bytes:
+        return _gif_frame(image, box, round(self.duration / 10))
+
+    def _emit(self, encoded: bytes, image: Image.Image, box: tuple[int, int], index: int):
+        self._write(encoded)
+
+    def _end(self):
+        self._write(b"\x3b")
+
+    def close(self):
+        super().close()
+        self._file.close()
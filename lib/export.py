@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import csv
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+from . import paths
+from .profiling import span
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .composite import WorldComposite
+
+
+EXPORT_FORMATS = ("none", "csv", "parquet")
+
+COLUMNS = ("time", "clade", "subspecies", "genome", "population", "base_id", "depth", "parent")
+
+
+def rows_of(composite: WorldComposite) -> Iterator[tuple]:
+    time = composite.time
+    for species in composite.species:
+        clade = species.clade
+        parent = None if (parent_clade := clade.parent) is None else parent_clade.string
+        for i, subspecies in enumerate(species.subspecies):
+            yield time, clade.string, i, subspecies.genome, subspecies.population, clade.base_id, clade.depth, parent
+
+
+class CsvTableWriter:
+    suffix = ".csv"
+
+    def __init__(self, path: Path):
+        self._file = open(path, "w", newline="")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(COLUMNS)
+
+    def write(self, rows: list[tuple]):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetTableWriter:
+    suffix = ".parquet"
+
+    def __init__(self, path: Path):
+        import pyarrow
+        import pyarrow.parquet
+
+        self._pyarrow = pyarrow
+        self._schema = pyarrow.schema([
+            ("time", pyarrow.int64()),
+            ("clade", pyarrow.string()),
+            ("subspecies", pyarrow.int32()),
+            ("genome", pyarrow.string()),
+            ("population", pyarrow.int64()),
+            ("base_id", pyarrow.int64()),
+            ("depth", pyarrow.int32()),
+            ("parent", pyarrow.string())
+        ])
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+
+    def write(self, rows: list[tuple]):
+        # Every checkpoint becomes its own row group, so readers can skip straight to the times they want.
+        columns = list(zip(*rows)) if rows else [()] * len(COLUMNS)
+        self._writer.write_table(self._pyarrow.Table.from_arrays(
+            [self._pyarrow.array(c, type=f.type) for c, f in zip(columns, self._schema)], schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+def _writer_type(export_format: str) -> type:
+    match export_format:
+        case "csv":
+            return CsvTableWriter
+        case "parquet":
+            try:
+                import pyarrow.parquet
+            except ImportError:
+                print("pyarrow is not installed, so the species history will be exported as csv instead of parquet.")
+                return CsvTableWriter
+            return ParquetTableWriter
+        case _:
+            raise ValueError(f"Unknown export_format {export_format}, expected one of {', '.join(EXPORT_FORMATS)}.")
+
+
+def export_history(composites: Iterable[WorldComposite], directory: Path, export_format: str,
+                   name: str = "species") -> Path:
+    writer_type = _writer_type(export_format)
+    path = Path(directory) / f"{name}{writer_type.suffix}"
+
+    print(f"Exporting species history to {path.name}...")
+
+    rows_written = 0
+    with span("export", format=export_format) as record, paths.replacing(path) as target:
+        writer = writer_type(target)
+        try:
+            # Composites may be streamed straight from the loader, so only one checkpoint's rows are held at a time.
+            for composite in composites:
+                rows = list(rows_of(composite))
+                writer.write(rows)
+                rows_written += len(rows)
+        finally:
+            writer.close()
+
+        if record is not None:
+            record.args["rows"] = rows_written
+
+    print(f"Exported {rows_written} rows to {path.name}.")
+
+    return path
@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import weakref
+from pathlib import Path
+
+from . import paths
+from .datamodel import Organism
+
+
+# Entries are written as {"id":"<id>","genome":{...}} on one line, so they can be indexed from the start and end of the
+# line alone. Stores written before the format was pinned have a space after each separator.
+_ENTRY_ID = re.compile(rb'\{"id": ?"([0-9a-f]+)",')
+_ENTRY_END = b"}}\n"
+
+
+def _entry_line(genome_id: str, genome: dict) -> bytes:
+    return (json.dumps({"id": genome_id, "genome": genome}, separators=(",", ":")) + "\n").encode()
+
+
+class GenomeStore:
+    def __init__(self, path: Path or None = None):
+        self.path: Path or None = None if path is None else Path(path)
+
+        # Stored genomes are only indexed by where their line is, and are parsed when an organism is asked for.
+        self._offsets: dict[str, tuple[int, int]] = {}
+        self._unsaved: dict[str, dict] = {}
+        # An organism is shared for as long as anything holds it, so its segments and radius are only ever worked out
+        # once, and it is freed with the last composite that uses it.
+        self._organisms: weakref.WeakValueDictionary[str, Organism] = weakref.WeakValueDictionary()
+        self._offset = 0
+        self._file = None
+
+        if self.path is not None and self.path.exists():
+            self._read()
+
+    def __enter__(self) -> GenomeStore:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self._offsets) + sum(1 for i in self._unsaved if i not in self._offsets)
+
+    def __contains__(self, genome_id: str):
+        return genome_id in self._offsets or genome_id in self._unsaved
+
+    def _read(self):
+        # Reading picks up where the last read stopped, since other runs sharing the cache may append to the store.
+        with self.path.open('rb') as file:
+            file.seek(self._offset)
+            for line in file:
+                # A line without its newline is still being written by another run, and is read once it's complete.
+                if not line.endswith(b"\n"):
+                    break
+                offset = self._offset
+                self._offset += len(line)
+
+                # A run that stopped while appending can leave a torn line, which is skipped rather than trusted.
+                if (match := _ENTRY_ID.match(line)) is not None and line.endswith(_ENTRY_END):
+                    self._offsets[match.group(1).decode()] = (offset, len(line))
+
+    def _load(self, genome_id: str) -> dict:
+        if (genome := self._unsaved.get(genome_id)) is not None:
+            return genome
+
+        if genome_id not in self._offsets and self.path is not None and self.path.exists():
+            # Another run sharing the cache may have stored it since the store was read.
+            self._read()
+
+        offset, length = self._offsets[genome_id]
+        if self._file is None:
+            self._file = self.path.open('rb')
+        self._file.seek(offset)
+        try:
+            return json.loads(self._file.read(length))["genome"]
+        except (ValueError, KeyError, TypeError):
+            raise KeyError(genome_id)
+
+    @staticmethod
+    def genome_of(organism: Organism) -> dict:
+        # Only the genetic code is identifying, so the same genome carried by different organisms shares one ID. The
+        # radius and bounds ride along so that layout can size nodes from the record alone.
+        return {
+            "geneticCode": organism.pack()["geneticCode"],
+            "radius": organism.radius,
+            "bounds": list(organism.bounds)
+        }
+
+    @staticmethod
+    def genome_id(genome: dict) -> str:
+        code = {"geneticCode": genome["geneticCode"]}
+        return hashlib.sha1(json.dumps(code, sort_keys=True, separators=(",", ":")).encode()).hexdigest()[:20]
+
+    def intern(self, organism: Organism) -> tuple[str, Organism]:
+        genome = self.genome_of(organism)
+        genome_id = self.genome_id(genome)
+
+        if genome_id not in self:
+            self._unsaved[genome_id] = genome
+
+        return genome_id, self._organisms.setdefault(genome_id, organism)
+
+    def organism(self, genome_id: str) -> Organism:
+        if (organism := self._organisms.get(genome_id)) is None:
+            organism = self._organisms[genome_id] = Organism(self._load(genome_id))
+        return organism
+
+    def flush(self):
+        if not self._unsaved or self.path is None:
+            return
+
+        lines = [(genome_id, _entry_line(genome_id, genome)) for genome_id, genome in self._unsaved.items()]
+
+        with paths.locked(self.path), self.path.open('a+b') as file:
+            # Appends are locked, so a line without its newline was torn by a run that stopped. New entries start on
+            # their own line, so it can't swallow the first of them.
+            if (offset := file.seek(0, os.SEEK_END)) > 0:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b"\n":
+                    file.write(b"\n")
+                    offset += 1
+            file.write(b"".join(line for _, line in lines))
+
+        # Once written, the records are only indexed, like the ones read from the store.
+        for genome_id, line in lines:
+            self._offsets[genome_id] = (offset, len(line))
+            offset += len(line)
+        self._unsaved = {}
+
+    def close(self):
+        # Genomes can still be asked for afterwards, which opens the store again.
+        if self._file is not None:
+            self._file.close()
+            self._file = None
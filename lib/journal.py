@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import dataclasses
+import hashlib
+import json
+from pathlib import Path
+
+from . import paths
+from .config import Settings
+
+
+class RunJournal:
+    def __init__(self, path: Path, key: str or None):
+        self.path: Path = Path(path)
+        self.key: str or None = key
+        self.done: set[str] = set()
+
+        # A journal left by a run with other settings or other checkpoints describes files this run can't reuse.
+        if key is not None and self.path.exists():
+            try:
+                entry = json.loads(self.path.read_text())
+                if entry["key"] == key:
+                    self.done = set(entry["done"])
+            except (ValueError, KeyError, TypeError):
+                pass
+
+    @staticmethod
+    def key_of(settings: Settings, layout_key: str or None) -> str or None:
+        if layout_key is None:
+            return None
+
+        # Profiling doesn't change what is drawn, so it can be switched on to look into a run that is being resumed.
+        values = {f.name: getattr(settings, f.name) for f in dataclasses.fields(settings)
+                  if not f.name.startswith("profile_")}
+        return hashlib.sha1(json.dumps([layout_key, values], sort_keys=True, default=str).encode()).hexdigest()
+
+    def finished(self, path: Path) -> bool:
+        return path.name in self.done and path.exists()
+
+    def complete(self, path: Path):
+        if self.key is None:
+            return
+
+        self.done.add(path.name)
+        with paths.replacing(self.path) as target:
+            target.write_text(json.dumps({"key": self.key, "done": sorted(self.done)}))
+
+    def finish(self):
+        self.path.unlink(missing_ok=True)
@@ -0,0 +1,321 @@
+from __future__ import annotations
+
+import dataclasses
+import hashlib
+import json
+import math
+from collections.abc import Iterator
+from pathlib import Path
+
+from . import paths
+from .config import Settings
+from .encode import STRIP_HEIGHT, PngStripWriter, palette_for
+from .profiling import span
+from .render import DrawList, PillowRenderer, Renderer, renderer_for
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .datamodel import Organism
+    from .composite import WorldComposite
+    from .draw import CladeDiagram
+
+
+LAYOUT_VERSION = 2
+
+LAYOUT_SETTINGS = (
+    "population_threshold",
+    "extinction_dead_zone",
+    "edge_margin",
+    "node_padding",
+    "node_min_radius",
+    "species_margin",
+    "species_min_width",
+    "generation_margin",
+    "generation_min_height",
+    "clade_focus"
+)
+
+
+def _shift(xy: tuple[int, float], top: int, scale: float) -> tuple[int, float]:
+    if scale == 1:
+        return (xy[0], xy[1] - top)
+    return (round(xy[0] * scale), round((xy[1] - top) * scale))
+
+
+def scaled_settings(settings: Settings, scale: float) -> Settings:
+    if scale == 1:
+        return settings
+
+    # Lines get thinner along with everything else, down to a single pixel.
+    return dataclasses.replace(
+        settings,
+        diagram_line_thickness=max(round(settings.diagram_line_thickness * scale), 1),
+        generation_line_thickness=max(round(settings.generation_line_thickness * scale), 1)
+    )
+
+
+def layout_key(settings: Settings, generation_worlds: list[WorldComposite]) -> str or None:
+    fingerprints = [w.fingerprint for w in generation_worlds]
+    if None in fingerprints:
+        return None
+
+    key = {
+        "version": LAYOUT_VERSION,
+        "settings": {k: getattr(settings, k) for k in LAYOUT_SETTINGS},
+        "checkpoints": fingerprints
+    }
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+
+class LayoutNode:
+    __slots__ = ("generation", "clade", "x", "y", "radius", "organism", "passthrough")
+
+    def __init__(self, generation: int, clade: str, x: int, y: float, radius: int, organism: Organism or None,
+                 passthrough: bool):
+        self.generation: int = generation
+        self.clade: str = clade
+        self.x: int = x
+        self.y: float = y
+        self.radius: int = radius
+        self.organism: Organism or None = organism
+        self.passthrough: bool = passthrough
+
+    @property
+    def top(self) -> tuple[int, float]:
+        return (self.x, self.y - self.radius)
+
+    @property
+    def bottom(self) -> tuple[int, float]:
+        return (self.x, self.y + self.radius)
+
+    @property
+    def xy(self) -> tuple[int, float]:
+        return (self.x, self.y)
+
+    @property
+    def right(self) -> int:
+        return self.x + self.radius
+
+
+class LayoutRow:
+    __slots__ = ("y", "height", "width")
+
+    def __init__(self, y: float, height: int, width: int):
+        self.y: float = y
+        self.height: int = height
+        self.width: int = width
+
+    @property
+    def top(self) -> float:
+        return self.y - self.height / 2
+
+    @property
+    def bottom(self) -> float:
+        return self.y + self.height / 2
+
+
+class Layout:
+    def __init__(self, settings: Settings, rows: list[LayoutRow], nodes: list[LayoutNode],
+                 connectors: list[tuple[int, int, int]]):
+        self.settings: Settings = settings
+        self.rows: list[LayoutRow] = rows
+        self.nodes: list[LayoutNode] = nodes
+        self.connectors: list[tuple[int, int, int]] = connectors
+
+    @classmethod
+    def from_diagram(cls, diagram: CladeDiagram) -> Layout:
+        rows = [LayoutRow(g.y_pos(), g.height(), g.width()) for g in diagram.generations]
+        generation_indices = {id(g): i for i, g in enumerate(diagram.generations)}
+
+        diagram_nodes = list(diagram.nodes())
+        node_indices = {id(n): i for i, n in enumerate(diagram_nodes)}
+
+        nodes = []
+        connectors = []
+        for node in diagram_nodes:
+            species = node.cspecies
+            representative = species.representative
+            children = species.get_children()
+            passthrough = len(children) == 1 \
+                and (parent := species.parent) is not None \
+                and len(parent.get_children()) == 1 \
+                and representative == parent.representative \
+                and representative == children[0].representative
+
+            nodes.append(LayoutNode(generation_indices[id(species.generation)], species.clade.string, node.x, node.y,
+                                    node.radius, representative, passthrough))
+
+            for child in children:
+                midrange = species.generation.midpoint(child.generation)
+                connectors.append((node_indices[id(node)], node_indices[id(child.node)], midrange))
+
+        return cls(diagram.settings, rows, nodes, connectors)
+
+    def to_data_dict(self) -> dict:
+        return {
+            "rows": [[r.y, r.height, r.width] for r in self.rows],
+            "nodes": [[n.generation, n.clade, n.x, n.y, n.radius, n.passthrough] for n in self.nodes],
+            "connectors": self.connectors
+        }
+
+    @classmethod
+    def from_data_dict(cls, data: dict, settings: Settings, generation_worlds: list[WorldComposite]) -> Layout:
+        species = [w.species_index.dict for w in generation_worlds]
+
+        rows = [LayoutRow(*r) for r in data["rows"]]
+        nodes = [LayoutNode(g, c, x, y, radius, species[g][c].representative, passthrough)
+                 for g, c, x, y, radius, passthrough in data["nodes"]]
+        connectors = [tuple(c) for c in data["connectors"]]
+
+        return cls(settings, rows, nodes, connectors)
+
+    @property
+    def generation_count(self) -> int:
+        return len(self.rows)
+
+    def _range(self, start: int, end: int or None) -> tuple[int, int]:
+        return start, self.generation_count if end is None else min(end, self.generation_count)
+
+    def viewport(self, start: int = 0, end: int or None = None) -> tuple[int, int, int]:
+        start, end = self._range(start, end)
+        margin = self.settings.edge_margin
+
+        top = round(self.rows[end - 1].top - margin)
+        bottom = round(self.rows[start].bottom + margin)
+        width = max(r.width for r in self.rows[start:end])
+
+        return top, width, bottom - top
+
+    def size(self, start: int = 0, end: int or None = None, scale: float = 1.0) -> tuple[int, int]:
+        _, width, height = self.viewport(start, end)
+        return max(math.ceil(width * scale), 1), max(math.ceil(height * scale), 1)
+
+    def _draw_connector(self, renderer: Renderer, connector: tuple[int, int, int], top: int, scale: float):
+        parent, child, midrange = connector
+        nodes = self.nodes
+        renderer.connector(_shift(nodes[parent].top, top, scale), _shift(nodes[child].bottom, top, scale),
+                           round((midrange - top) * scale))
+
+    def _draw_node(self, renderer: Renderer, node: LayoutNode, top: int, scale: float):
+        xy = _shift(node.xy, top, scale)
+        if node.passthrough:
+            renderer.connector(_shift(node.bottom, top, scale), _shift(node.top, top, scale), xy[1])
+            return
+
+        # Nodes too small to make out their organism are drawn as a dot of its main color instead.
+        radius = node.radius * scale
+        if radius < self.settings.detail_min_radius:
+            color = node.organism.dominant_color
+            renderer.dot(xy, radius, self.settings.diagram_line_color.rgb if color is None else color.rgb)
+            return
+
+        renderer.circle(xy, radius)
+        renderer.organism(xy, node.organism, scale)
+
+    def render(self, renderer: Renderer, start: int = 0, end: int or None = None, scale: float = 1.0):
+        start, end = self._range(start, end)
+        top, _, _ = self.viewport(start, end)
+
+        if self.settings.generation_lines_enabled:
+            print("Drawing generation lines...")
+            for row in self.rows[start:end]:
+                renderer.generation_line((row.y - top) * scale)
+
+        nodes = self.nodes
+
+        def inside(node: LayoutNode) -> bool:
+            return start <= node.generation < end
+
+        connectors = [c for c in self.connectors if inside(nodes[c[0]]) or inside(nodes[c[1]])]
+        connectors_count = len(connectors)
+
+        print("Drawing diagram connectors...")
+        with span("connectors", connectors=connectors_count):
+            for i, connector in enumerate(connectors):
+                if i % 100 == 0:
+                    print(f"Drawing connectors... ({i}/{connectors_count})")
+
+                self._draw_connector(renderer, connector, top, scale)
+
+        visible = [n for n in nodes if inside(n)]
+        nodes_count = len(visible)
+
+        print("Drawing species nodes...")
+        with span("nodes", nodes=nodes_count):
+            for i, node in enumerate(visible):
+                if i % 100 == 0:
+                    print(f"Drawing organisms... ({i}/{nodes_count})")
+
+                self._draw_node(renderer, node, top, scale)
+
+    def render_generations(self, renderer: Renderer, scale: float = 1.0) -> Iterator[int]:
+        # Each generation is drawn on top of the ones before it: its generation line, the connectors up from its
+        # parents, then its nodes. Connectors only ever span neighbouring rows and never cross a generation line. The
+        # parents are drawn again over the ends of their new connectors, as render draws every node after every
+        # connector, so once every generation is drawn the image is the same as render's.
+        top, _, _ = self.viewport()
+        nodes = self.nodes
+
+        incoming = [[] for _ in self.rows]
+        for connector in self.connectors:
+            incoming[nodes[connector[1]].generation].append(connector)
+
+        members = [[] for _ in self.rows]
+        for node in nodes:
+            members[node.generation].append(node)
+
+        for generation, row in enumerate(self.rows):
+            if self.settings.generation_lines_enabled:
+                renderer.generation_line((row.y - top) * scale)
+
+            for connector in incoming[generation]:
+                self._draw_connector(renderer, connector, top, scale)
+
+            for parent in dict.fromkeys(c[0] for c in incoming[generation]):
+                self._draw_node(renderer, nodes[parent], top, scale)
+
+            for node in members[generation]:
+                self._draw_node(renderer, node, top, scale)
+
+            yield generation
+
+    def _render_png_strips(self, path: Path, target: Path, start: int, end: int or None, scale: float):
+        settings = scaled_settings(self.settings, scale)
+        width, height = size = self.size(start, end, scale)
+
+        print("Recording diagram...")
+        draw_list = DrawList(size, settings)
+        self.render(draw_list, start, end, scale)
+
+        palette = palette_for(draw_list.colors()) if settings.palette_quantize else None
+        strips = draw_list.strip_index(STRIP_HEIGHT)
+        strips_count = math.ceil(height / STRIP_HEIGHT)
+
+        print(f"Writing {path.name}...")
+        with span("encoding", file=path.name, strips=strips_count) as record, \
+                PngStripWriter(target, size, palette, settings) as writer:
+            for row in range(strips_count):
+                top = row * STRIP_HEIGHT
+                renderer = PillowRenderer(None, (width, min(STRIP_HEIGHT, height - top)), settings, palette)
+                draw_list.replay(renderer, (0, top), strips.get(row, []))
+                writer.write(renderer.rasterize())
+
+        if record is not None:
+            record.args["bytes"] = writer.bytes_written
+
+    def render_to_file(self, path, start: int = 0, end: int or None = None, scale: float = 1.0):
+        path = Path(path)
+
+        # The image is written beside its final path and only moved over it once complete, so an interrupted run
+        # never leaves a truncated image behind.
+        with paths.replacing(path) as target:
+            if path.suffix.lower() == ".png" and self.settings.encoder_threads != 0:
+                self._render_png_strips(path, target, start, end, scale)
+                return
+
+            print("Initializing image...")
+            renderer_class = renderer_for(path.suffix.lstrip("."))
+            size = self.size(start, end, scale)
+            with renderer_class(target, size, scaled_settings(self.settings, scale)) as renderer:
+                self.render(renderer, start, end, scale)
+                print(f"Writing {path.name}...")
@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+from .datamodel import Clade
+
+
+def clade_key(clade: Clade) -> tuple[int, tuple[str, ...]]:
+    return clade.base_id, tuple(clade.lineage)
+
+
+class LineageGraph:
+    def __init__(self, generations: list[list[Clade]]):
+        self.generation_of: list[int] = []
+        self.parents: list[int] = []
+        self.children: list[list[int]] = []
+        self.alive: list[bool] = []
+
+        self._heights: list[int] or None = None
+
+        previous = {}
+        for generation, clades in enumerate(generations):
+            current = {}
+            for clade in clades:
+                node = len(self.parents)
+                parent = self._nearest_ancestor(clade, previous)
+
+                self.generation_of.append(generation)
+                self.parents.append(parent)
+                self.children.append([])
+                self.alive.append(True)
+                if parent != -1:
+                    self.children[parent].append(node)
+
+                # The first species of a clade in a generation wins ties, as the old candidate scan did.
+                current.setdefault(clade_key(clade), node)
+            previous = current
+
+    def __len__(self):
+        return len(self.parents)
+
+    @staticmethod
+    def _nearest_ancestor(clade: Clade, previous: dict[tuple[int, tuple[str, ...]], int]) -> int:
+        # A parent is the closest clade in the previous generation that is the same clade or one of its ancestors, so
+        # the lineage prefixes are tried from longest to shortest.
+        base_id, lineage = clade_key(clade)
+        for length in range(len(lineage), -1, -1):
+            if (node := previous.get((base_id, lineage[:length]))) is not None:
+                return node
+        return -1
+
+    def parent(self, node: int) -> int:
+        return self.parents[node]
+
+    def remove(self, nodes: list[int]):
+        removed = set(nodes)
+        for node in removed:
+            self.alive[node] = False
+            if (parent := self.parents[node]) != -1 and parent not in removed:
+                self.children[parent].remove(node)
+        self._heights = None
+
+    def reorder(self, order: list[int]):
+        # Children are kept in the order their generation lists them, so a new generation order has to be replayed.
+        for node in order:
+            if (parent := self.parents[node]) != -1:
+                self.children[parent] = []
+        for node in order:
+            if (parent := self.parents[node]) != -1:
+                self.children[parent].append(node)
+        self._heights = None
+
+    def height(self, node: int) -> int:
+        if (heights := self._heights) is None:
+            # Node IDs are assigned generation by generation, so every child has a higher ID than its parent.
+            heights = self._heights = [0] * len(self.parents)
+            for n in range(len(heights) - 1, -1, -1):
+                if children := self.children[n]:
+                    heights[n] = max(heights[c] for c in children) + 1
+        return heights[node]
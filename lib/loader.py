@@ -1,19 +1,38 @@
+import codecs
+import io
 import json
+import re
 
 import javaobj.v2 as javaobj
 from collections import UserDict
-from typing import Any
+from typing import Any, BinaryIO
+from collections.abc import Iterable, Iterator
 from pathlib import Path
 
-from . import paths
-from .datamodel import World
+from . import paths, sampling
+from .profiling import span
+from .datamodel import World, StreamedWorld, Clade
 from .composite import WorldComposite
+from .genomes import GenomeStore
+from .config import Settings
+from .layout import Layout, layout_key
 from .paths import seek
+from .prefetch import Prefetcher
+from .population import PopulationMatrix
 
 
 _OLD_CLADE_DIR = Path(".clade")
 _OLD_CACHE_DIR = _OLD_CLADE_DIR / "cache"
 
+_KEPT_LAYOUTS = 8
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_CHUNK_SIZE = 1 << 16
+
+_CHECKPOINT_TIME = re.compile(r"@(\d+)")
+_CACHE_TIME = re.compile(rb'^\{"time": (-?\d+)')
+_CACHE_HEADER_SIZE = 64
+
 
 class _IdentityDict(UserDict):
     def __setitem__(self, key, value):
@@ -31,12 +50,16 @@ class _IdentityDict(UserDict):
         return new_dict
 
 
-def load_bgw(path, verbose=False):
+def load_bgw(path, verbose=False, data: bytes or None = None):
     if verbose:
         print(f"Reading {path}...")
 
-    with open(path, "rb") as bgw_file:
-        return javaobj.load(bgw_file)
+    if data is None:
+        with span("reading", file=Path(path).name):
+            data = Path(path).read_bytes()
+
+    with span("parsing", file=Path(path).name):
+        return javaobj.load(io.BytesIO(data))
 
 
 def _strip_key_underscores(d: dict, recursive=False):
@@ -93,16 +116,17 @@ def javaobj_to_data(jobj: Any, _stack=None):
             return jobj
 
 
-def load_bgw_data(path, verbose=False):
+def load_bgw_data(path, verbose=False, data: bytes or None = None):
     path = Path(path)
     filename = path.name
 
-    bgw = load_bgw(path, verbose)
+    bgw = load_bgw(path, verbose, data)
 
     if verbose:
         print(f"Indexing {filename}...")
 
-    data = javaobj_to_data(bgw)
+    with span("indexing", file=filename):
+        data = javaobj_to_data(bgw)
 
     if verbose:
         print(f"Finished indexing {filename}.")
@@ -110,67 +134,190 @@ def load_bgw_data(path, verbose=False):
     return data
 
 
-def load_bgw_as_world(path, verbose=False):
-    return World(load_bgw_data(path, verbose))
+def load_bgw_as_world(path, verbose=False, data: bytes or None = None):
+    return World(load_bgw_data(path, verbose, data))
+
+
+def _normalize_organism(organism: dict) -> dict or None:
+    # Only the keys that Organism and Gene read are normalised, and dead organisms are dropped before even that.
+    _strip_key_underscores(organism)
+    if not organism.get("alive", True):
+        return None
+
+    if isinstance(genetic_code := organism.get("geneticCode"), dict):
+        _strip_key_underscores(genetic_code)
+        for gene in genetic_code.get("genes", ()):
+            _strip_key_underscores(gene)
+            if isinstance(color := gene.get("color"), dict):
+                _strip_key_underscores(color)
+
+    return organism
+
+
+class _JsonStream:
+    def __init__(self, chunks: Iterator[str]):
+        self._chunks = chunks
+        self._text = ""
+        self._pos = 0
+        self._decoder = json.JSONDecoder()
+
+    def _extend(self) -> bool:
+        # Text that has been decoded is dropped as more is read, so only the value in progress is buffered. The
+        # undecoded text at least doubles each time, so a value spanning many chunks is only decoded a few times over.
+        wanted = max(len(self._text) - self._pos, _CHUNK_SIZE)
+        parts = [self._text[self._pos:]]
+        read = 0
+        for chunk in self._chunks:
+            parts.append(chunk)
+            read += len(chunk)
+            if read >= wanted:
+                break
+
+        if not read:
+            return False
+
+        self._text = "".join(parts)
+        self._pos = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            self._pos = _WHITESPACE.match(self._text, self._pos).end()
+            if self._pos < len(self._text):
+                return self._text[self._pos]
+            if not self._extend():
+                return ""
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise json.JSONDecodeError(f"Expecting '{char}'", self._text, self._pos)
+        self._pos += 1
+
+    def skip(self, char: str):
+        if self.peek() == char:
+            self._pos += 1
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._text, self._pos)
+            except json.JSONDecodeError:
+                if not self._extend():
+                    raise
+                continue
+
+            # A number cut off by the end of a chunk still decodes, so a value that runs to the end of the buffer is
+            # only trusted once there is nothing more to read.
+            if end == len(self._text) and self._extend():
+                continue
+
+            self._pos = end
+            return value
+
+
+def _decoded_chunks(file: BinaryIO) -> Iterator[str]:
+    with file:
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        while chunk := file.read(_CHUNK_SIZE):
+            yield decoder.decode(chunk)
+        yield decoder.decode(b"", final=True)
+
+
+def stream_json_save(chunks: Iterable[str], data: dict) -> Iterator[dict]:
+    stream = _JsonStream(iter(chunks))
+
+    stream.expect("{")
+    while stream.peek() != "}":
+        key = stream.value()
+        stream.expect(":")
+
+        if key.lstrip("_") == "organisms" and stream.peek() == "[":
+            # The organism list is decoded one organism at a time, so only one is ever held outside the composite.
+            stream.expect("[")
+            while stream.peek() != "]":
+                if (organism := _normalize_organism(stream.value())) is not None:
+                    yield organism
+                stream.skip(",")
+            stream.expect("]")
+        else:
+            data[key] = stream.value()
+
+        stream.skip(",")
 
+    _strip_key_underscores(data, recursive=True)
 
-def load_json_data(path, verbose=False):
+
+def load_json_as_world(path, verbose=False, raw: bytes or None = None) -> World:
     path = Path(path)
 
     if verbose:
         print(f"Reading {path.name}...")
 
-    with path.open('r') as json_file:
-        data = json.load(json_file)
-
-    _strip_key_underscores(data, recursive=True)
-    data["organisms"] = {"list": data["organisms"]}
-
-    if verbose:
-        print(f"Read {path.name}.")
-
-    return data
+    # A save that wasn't prefetched is streamed from disk. Either way it is decoded a chunk at a time, so the save is
+    # never held as text as well as bytes.
+    file = path.open('rb') if raw is None else io.BytesIO(raw)
 
+    data = {}
+    return StreamedWorld(data, stream_json_save(_decoded_chunks(file), data))
 
-def load_json_as_world(path, verbose=False):
-    return World(load_json_data(path, verbose))
 
-
-def load_composite_from_save(path, verbose=False) -> WorldComposite:
+def load_composite_from_save(path, verbose=False, data: bytes or None = None,
+                             genomes: GenomeStore or None = None, focus: Clade or None = None) -> WorldComposite:
     path = Path(path)
 
     cache = seek(path.parent, paths.CACHE)
 
     if (cached_composite := cache / f"{path.stem}.json").exists():
-        return load_composite_from_cache(cached_composite, verbose)
-    else:
+        return load_composite_from_cache(cached_composite, verbose, genomes=genomes, focus=focus)
+
+    # Runs sharing the world take turns building each entry, so a run that had to wait reuses the entry instead of
+    # building it again.
+    with paths.locked(cached_composite):
+        if cached_composite.exists():
+            return load_composite_from_cache(cached_composite, verbose, genomes=genomes, focus=focus)
+
         match path.suffix:
             case '.json':
-                world = load_json_as_world(path, verbose=verbose)
+                world = load_json_as_world(path, verbose=verbose, raw=data)
             case '.bgw':
-                world = load_bgw_as_world(path, verbose=verbose)
+                world = load_bgw_as_world(path, verbose=verbose, data=data)
             case _:
                 raise ValueError()
 
         print(f"Saving {path.name} to cache...")
 
-        composite = WorldComposite(world)
+        with span("composite", file=path.name):
+            composite = WorldComposite(world, genomes)
+
+        # The cache only references genomes by ID, so they have to be stored before it is.
+        if genomes is not None:
+            genomes.flush()
 
-        with cached_composite.open('w') as file:
+        with span("cache_write", file=cached_composite.name), paths.replacing(cached_composite) as target, \
+                target.open('w') as file:
             json.dump(composite.to_data_dict(), file)
+        composite.fingerprint = _fingerprint(cached_composite)
 
-        if verbose:
-            print(f"Saved {path.name} data to cache.")
+    # The cache always holds the whole world, so it can be shared by runs with any focus.
+    if focus is not None:
+        composite.focus(focus)
 
-        return composite
+    if verbose:
+        print(f"Saved {path.name} data to cache.")
 
+    return composite
 
-def load_composite_from_cache(path, verbose=False):
+
+def load_composite_from_cache(path, verbose=False, data: bytes or None = None, genomes: GenomeStore or None = None,
+                              focus: Clade or None = None):
     path = Path(path)
 
-    with path.open('r') as file:
-        data = json.load(file)
-    composite = WorldComposite(data)
+    with span("cache_read", file=path.name):
+        if data is None:
+            data = path.read_bytes()
+        composite = WorldComposite(json.loads(data), genomes, focus)
+    composite.fingerprint = _fingerprint(path)
 
     if verbose:
         print(f"Loaded {path.stem} from cache.")
@@ -178,31 +325,247 @@ def load_composite_from_cache(path, verbose=False):
     return composite
 
 
+def _fingerprint(path: Path) -> str:
+    stat = path.stat()
+    return f"{path.stem}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def load_cached_layout(path, settings: Settings, composites: list[WorldComposite]) -> Layout or None:
+    if (key := layout_key(settings, composites)) is None:
+        return None
+
+    if not (cached_layout := seek(Path(path), paths.LAYOUT_CACHE) / f"{key}.json").exists():
+        return None
+
+    with span("cache_read", file=cached_layout.name):
+        try:
+            with cached_layout.open('r') as file:
+                data = json.load(file)
+            layout = Layout.from_data_dict(data, settings, composites)
+        except FileNotFoundError:
+            # Another run trimmed it from the cache in the meantime.
+            return None
+        except (ValueError, KeyError, TypeError, IndexError):
+            # A damaged layout is only a cache miss, since it can always be laid out again.
+            print("Cached clade layout is damaged, laying the clade out again...")
+            cached_layout.unlink(missing_ok=True)
+            return None
+
+    print("Loaded clade layout from cache.")
+
+    return layout
+
+
+def cache_layout(path, layout: Layout, composites: list[WorldComposite]):
+    if (key := layout_key(layout.settings, composites)) is None:
+        return
+
+    cache = seek(Path(path), paths.LAYOUT_CACHE)
+
+    with span("cache_write", file=f"{key}.json"), paths.replacing(cache / f"{key}.json") as target, \
+            target.open('w') as file:
+        json.dump(layout.to_data_dict(), file)
+
+    # Trimming is locked so runs sharing the cache don't trip over each other's deletions.
+    with paths.locked(cache):
+        layouts = [f for f in cache.glob("*.json") if not f.name.startswith(".")]
+        layouts.sort(key=lambda f: f.stat().st_mtime_ns, reverse=True)
+        for stale in layouts[_KEPT_LAYOUTS:]:
+            stale.unlink(missing_ok=True)
+
+
 def _to_names(fps: list[Path]):
     return [fp.stem for fp in fps]
 
 
-def load_composites(path, verbose=False) -> list[WorldComposite]:
+class Checkpoint:
+    __slots__ = ("file", "load", "time", "save", "composite")
+
+    def __init__(self, file: Path, load, time: int or None, save: Path or None = None):
+        self.file: Path = file
+        self.load = load
+        self.time: int or None = time
+        self.save: Path or None = save
+        self.composite: WorldComposite or None = None
+
+    @property
+    def stem(self) -> str:
+        return self.file.stem
+
+
+def _cached_time(file: Path) -> int or None:
+    # Cached composites are written with their time first, so a few bytes are enough to place them.
+    with file.open("rb") as f:
+        match = _CACHE_TIME.match(f.read(_CACHE_HEADER_SIZE))
+    return None if match is None else int(match.group(1))
+
+
+def _checkpoint_time(file: Path) -> int or None:
+    if (match := _CHECKPOINT_TIME.search(file.stem)) is None:
+        return None
+    return int(match.group(1))
+
+
+def load_genomes(path) -> GenomeStore:
+    return GenomeStore(seek(Path(path), paths.GENOMES.parent) / paths.GENOMES.name)
+
+
+def _load_checkpoint(checkpoint: Checkpoint, data: bytes or None, verbose: bool, genomes: GenomeStore or None,
+                     focus: Clade or None) -> WorldComposite:
+    try:
+        return checkpoint.load(checkpoint.file, verbose=verbose, data=data, genomes=genomes, focus=focus)
+    except (ValueError, KeyError, TypeError) as error:
+        if checkpoint.load is not load_composite_from_cache:
+            raise
+        if checkpoint.save is None:
+            raise ValueError(f"Cached {checkpoint.stem} is damaged and its world file is missing, so it can't be "
+                             f"rebuilt. Delete {checkpoint.file} to skip it.") from error
+
+    # A cache entry torn by a stopped run, or one naming genomes the store never received, is rebuilt from its save.
+    print(f"Cached {checkpoint.stem} is damaged, rebuilding it from {checkpoint.save.name}...")
+    checkpoint.file.unlink(missing_ok=True)
+    checkpoint.file, checkpoint.load = checkpoint.save, load_composite_from_save
+    return load_composite_from_save(checkpoint.save, verbose=verbose, genomes=genomes, focus=focus)
+
+
+def _iter_checkpoints(checkpoints: list[Checkpoint], verbose: bool, window: int, genomes: GenomeStore or None,
+                      focus: Clade or None = None) -> Iterator[Checkpoint]:
+    pending = [c for c in checkpoints if c.composite is None]
+
+    # A reader thread fetches the next few files while the current one is parsed, so slow disks and network shares
+    # don't add their latency on top of parsing.
+    with Prefetcher([c.file for c in pending], window) as prefetcher:
+        files = iter(prefetcher)
+        for checkpoint in checkpoints:
+            if checkpoint.composite is None:
+                _, data = next(files)
+                checkpoint.composite = _load_checkpoint(checkpoint, data, verbose, genomes, focus)
+                checkpoint.time = checkpoint.composite.time
+            yield checkpoint
+
+
+def _load_checkpoints(checkpoints: list[Checkpoint], verbose: bool, window: int, genomes: GenomeStore or None,
+                      focus: Clade or None = None):
+    for _ in _iter_checkpoints(checkpoints, verbose, window, genomes, focus):
+        pass
+
+
+def index_checkpoints(path, verbose=False, window: int = 0, genomes: GenomeStore or None = None,
+                      focus: Clade or None = None) -> list[Checkpoint]:
     path = Path(path)
 
-    files_to_load = []
-    cataloged_checkpoints = set()
+    saves = {}
+    for pattern in ('*@*.json', '*@*.bgw'):
+        for file in sorted(path.glob(pattern)):
+            saves.setdefault(file.stem, file)
+
+    checkpoints = []
+    cached = set()
+
+    for file in sorted(seek(path, paths.CACHE).glob('*.json')):
+        # Hidden files are cache entries still being written, or left behind by a run that was stopped.
+        if file.name.startswith("."):
+            continue
+        if (time := _cached_time(file)) is None:
+            time = _checkpoint_time(file)
+        # The save is remembered so a damaged cache entry can be rebuilt from it.
+        checkpoints.append(Checkpoint(file, load_composite_from_cache, time, saves.get(file.stem)))
+        cached.add(file.stem)
 
-    for directory, pattern, load in [
-        (seek(path, paths.CACHE), '*.json', load_composite_from_cache),
-        (path, '*@*.json', load_composite_from_save),
-        (path, '*@*.bgw', load_composite_from_save)
-    ]:
-        for file in sorted(list(directory.glob(pattern))):
-            if file.stem not in cataloged_checkpoints:
-                files_to_load.append((file, load))
-            cataloged_checkpoints.add(file.stem)
+    for stem, file in saves.items():
+        if stem not in cached:
+            checkpoints.append(Checkpoint(file, load_composite_from_save, _checkpoint_time(file), file))
 
-    composites = [l(f, verbose=verbose) for f, l in files_to_load]
+    # Only checkpoints whose time can't be told from their name or cache header have to be loaded to be placed.
+    _load_checkpoints([c for c in checkpoints if c.time is None], verbose, window, genomes, focus)
+
+    checkpoints.sort(key=lambda c: (c.time, c.stem))
+    return checkpoints
+
+
+def focus_of(settings: Settings) -> Clade or None:
+    if not (focus := settings.clade_focus.strip()):
+        return None
+
+    if re.match(r"^(?:.*:)?\d+", focus) is None:
+        raise ValueError(f"clade_focus {focus} is not a clade or base ID.")
+    return Clade(focus)
+
+
+def _in_range(checkpoints: list[Checkpoint], settings: Settings) -> list[Checkpoint]:
+    start, end = (i if i != -1 else len(checkpoints) for i in (settings.clade_start, settings.clade_end))
+    return checkpoints[start - 1:end]
+
+
+def load_composites(path, settings: Settings, verbose=False) -> list[WorldComposite]:
+    path = Path(path)
+    window = settings.prefetch_window
+    focus = focus_of(settings)
+
+    with load_genomes(path) as genomes, span("loading", sampling=settings.sampling_mode) as record:
+        checkpoints = _in_range(index_checkpoints(path, verbose, window, genomes, focus), settings)
+        count = len(checkpoints)
+        interval = settings.sampling_interval
+
+        def load(indices: list[int]) -> list[WorldComposite]:
+            selected = [checkpoints[i] for i in indices]
+            _load_checkpoints(selected, verbose, window, genomes, focus)
+            return [c.composite for c in selected]
+
+        match settings.sampling_mode:
+            case "all":
+                composites = load(list(range(count)))
+            case "nth":
+                composites = load(sampling.every_nth(count, interval))
+            case "time":
+                composites = load(sampling.time_spaced([c.time for c in checkpoints], interval))
+            case "adaptive":
+                sampled = sampling.adaptive(count, interval, settings.population_threshold, load)
+                composites = [sampled[i] for i in sorted(sampled)]
+            case _:
+                raise ValueError(f"Unknown sampling_mode {settings.sampling_mode}, expected one of "
+                                 f"{', '.join(sampling.SAMPLING_MODES)}.")
+
+        if record is not None:
+            record.args["checkpoints"] = len(composites)
+            record.args["genomes"] = len(genomes)
 
     composites.sort(key=lambda c: c.time)
 
     if verbose:
+        if len(composites) != count:
+            print(f"Sampled {len(composites)} of {count} world checkpoints.")
         print(f"Loaded {len(composites)} world checkpoints.")
 
     return composites
+
+
+def load_population(path, settings: Settings, verbose=False) -> PopulationMatrix:
+    composites = load_composites(path, settings, verbose)
+
+    with span("population", checkpoints=len(composites)):
+        return PopulationMatrix.from_composites(composites)
+
+
+def iter_composites(path, settings: Settings, verbose=False) -> Iterator[WorldComposite]:
+    path = Path(path)
+    window = settings.prefetch_window
+    focus = focus_of(settings)
+
+    with load_genomes(path) as genomes:
+        checkpoints = _in_range(index_checkpoints(path, verbose, window, genomes, focus), settings)
+        count = len(checkpoints)
+
+        # Sampling is applied where it can be decided up front. Adaptive sampling has to compare loaded checkpoints, so
+        # every checkpoint is streamed instead.
+        match settings.sampling_mode:
+            case "nth":
+                checkpoints = [checkpoints[i] for i in sampling.every_nth(count, settings.sampling_interval)]
+            case "time":
+                checkpoints = [checkpoints[i] for i in
+                               sampling.time_spaced([c.time for c in checkpoints], settings.sampling_interval)]
+
+        # Each composite is handed over and forgotten, so only the one being consumed is held at a time.
+        for checkpoint in _iter_checkpoints(checkpoints, verbose, window, genomes, focus):
+            composite, checkpoint.composite = checkpoint.composite, None
+            yield composite
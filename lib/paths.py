@@ -1,9 +1,26 @@
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
 from pathlib import Path
+import hashlib
+import os
+import re
 import shutil
+import time
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
 
 CLADE = Path("clade")
 CACHE = CLADE / ".cache"
+LAYOUT_CACHE = CACHE / "layout"
+GENOMES = CACHE / "genomes.jsonl"
 OUTPUT = CLADE / "output"
+PROFILE = CLADE / "profile"
+JOURNAL = OUTPUT / ".journal.json"
+TILES = OUTPUT / "tiles"
+RUNS = CLADE / "runs"
 
 CONFIG = CLADE / "config.ini"
 
@@ -34,9 +51,196 @@ def config(master: Path) -> Path:
     return config_status(master)[0]
 
 
-def clear(dir_path: Path):
+def output(master: Path, run_config: Path or None = None) -> Path:
+    if run_config is None:
+        return seek(master, OUTPUT)
+
+    # Runs with another config write to a directory of their own, so several of them can render the same world at once.
+    # Its name carries a hash of the config's full path, so configs that share a file name don't share outputs.
+    digest = hashlib.sha1(str(Path(run_config).resolve()).encode()).hexdigest()[:8]
+    return seek(master, RUNS / f"{Path(run_config).stem}-{digest}")
+
+
+def _remove(path: Path):
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists():
+        path.unlink()
+
+
+def prune(dir_path: Path, keep: Iterable[str] = ()):
+    keep = set(keep)
     for path in dir_path.iterdir():
-        if path.is_file():
-            path.unlink()
-        elif path.is_dir():
-            shutil.rmtree(path)
+        if path.name not in keep:
+            _remove(path)
+
+
+_LOCK_POLL = 0.1
+
+
+def _try_lock(file) -> bool:
+    try:
+        if os.name == "nt":
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+def _lock_path(path: Path) -> Path:
+    return path.with_name(f".{path.name}.lock")
+
+
+def _is_current(lock: Path, file) -> bool:
+    # Open files can't be removed on Windows, so there a held lock file is always the current one.
+    if os.name == "nt":
+        return True
+    try:
+        return os.stat(lock).st_ino == os.fstat(file.fileno()).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def _acquire(lock: Path, name: str, blocking=True):
+    # A lock file is removed by the run holding it once it isn't needed, so a run that was waiting on it can end up
+    # holding a file that is gone. It then starts over with a fresh one.
+    waiting = False
+    while True:
+        file = lock.open('a+b')
+        while not _try_lock(file):
+            if not blocking:
+                file.close()
+                return None
+            if not waiting:
+                print(f"Waiting for another run to finish with {name}...")
+                waiting = True
+            time.sleep(_LOCK_POLL)
+
+        if _is_current(lock, file):
+            return file
+        file.close()
+
+
+def _release(lock: Path, file, discard: bool):
+    if discard and os.name != "nt":
+        lock.unlink(missing_ok=True)
+
+    if os.name == "nt":
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+    file.close()
+
+    if discard and os.name == "nt":
+        try:
+            lock.unlink(missing_ok=True)
+        except PermissionError:
+            # Another run already has it open to take the lock next.
+            pass
+
+
+@contextmanager
+def locked(path: Path) -> Iterator[None]:
+    # The lock is held by the operating system rather than by the lock file existing, so it is released even when the
+    # run holding it crashes, and a lock file that is left behind is never mistaken for a live one.
+    path = Path(path)
+    lock = _lock_path(path)
+    file = _acquire(lock, path.name)
+
+    discard = False
+    try:
+        yield
+        # Once what the lock guards exists, runs that come along later find it without taking the lock.
+        discard = path.exists()
+    finally:
+        _release(lock, file, discard)
+
+
+_LEFTOVER = re.compile(r"^\.(.+)\.(\d+)\.(tmp|old)(\.[^.]*)?$")
+
+
+def _running(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+
+    if os.name == "nt":
+        # os.kill would end the process on Windows rather than probe it, so its exit code is asked for instead.
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        if not (handle := kernel32.OpenProcess(0x1000, False, pid)):
+            return kernel32.GetLastError() == 5
+        code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+        kernel32.CloseHandle(handle)
+        return code.value == 259
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def sweep(dir_path: Path):
+    # Temporary files and directories are named after the run writing them, so ones left by runs that were killed can
+    # be told apart from ones another run is still writing.
+    for path in dir_path.iterdir():
+        if path.name.startswith(".") and path.suffix == ".lock":
+            # Lock files nobody holds were left by runs that crashed.
+            if (file := _acquire(path, path.name, blocking=False)) is not None:
+                _release(path, file, True)
+            continue
+
+        if (match := _LEFTOVER.match(path.name)) is None or _running(int(match.group(2))):
+            continue
+
+        original = path.with_name(match.group(1))
+        if match.group(3) == "old" and not original.exists():
+            # The run stopped between moving the old directory aside and moving the new one in.
+            os.replace(path, original)
+        else:
+            _remove(path)
+
+
+def temp_path(path: Path) -> Path:
+    # The suffix is kept, since image formats are told apart by it.
+    return path.with_name(f".{path.stem}.{os.getpid()}.tmp{path.suffix}")
+
+
+def _fsync(path: Path):
+    with path.open('ab') as file:
+        os.fsync(file.fileno())
+
+
+@contextmanager
+def replacing(path: Path, directory=False) -> Iterator[Path]:
+    # Everything is written to a temporary path next to the real one, which only replaces it once it is complete.
+    # A run that is stopped partway through leaves the previous file in place, rather than half of a new one.
+    path = Path(path)
+    temp = temp_path(path)
+    _remove(temp)
+    if directory:
+        temp.mkdir(parents=True)
+
+    try:
+        yield temp
+
+        if directory:
+            # A directory can't be replaced in one step, so the old one is moved aside first.
+            old = path.with_name(f".{path.name}.{os.getpid()}.old")
+            _remove(old)
+            if path.exists():
+                os.replace(path, old)
+            os.replace(temp, path)
+            _remove(old)
+        else:
+            _fsync(temp)
+            os.replace(temp, path)
+    finally:
+        _remove(temp)
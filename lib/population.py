@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+from bisect import bisect_left
+
+import numpy as np
+
+from .datamodel import Clade
+from .lineage import clade_key
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .composite import WorldComposite
+
+
+class PopulationMatrix:
+    def __init__(self, times: list[int], clades: list[Clade], rows: list[int], columns: list[int],
+                 populations: list[int]):
+        # The matrix is stored sparse, one entry per species per checkpoint, in the same order the composites list
+        # their species. Entry indices are therefore the node IDs of a LineageGraph built from the same composites.
+        self.times: np.ndarray = np.asarray(times, dtype=np.int64)
+        self.clades: list[Clade] = clades
+        self.rows: np.ndarray = np.asarray(rows, dtype=np.intp)
+        self.columns: np.ndarray = np.asarray(columns, dtype=np.intp)
+        self.populations: np.ndarray = np.asarray(populations, dtype=np.int64)
+
+        self._columns: dict[tuple[int, tuple[str, ...]], int] = {clade_key(c): i for i, c in enumerate(clades)}
+
+        # Sorting clades by base ID and lineage puts every clade directly in front of its descendants, so each
+        # clade's subtree is one contiguous run of that order.
+        keys = [clade_key(c) for c in clades]
+        self._order: np.ndarray = np.array(sorted(range(len(clades)), key=keys.__getitem__), dtype=np.intp)
+        self._position: np.ndarray = np.empty(len(clades), dtype=np.intp)
+        self._position[self._order] = np.arange(len(clades))
+        ordered = [keys[i] for i in self._order]
+        self._subtree_end: np.ndarray = np.array(
+            [bisect_left(ordered, (base_id, lineage + ("\uffff",))) for base_id, lineage in keys], dtype=np.intp)
+
+        self.clade_parents: np.ndarray = np.array([self._nearest_ancestor(c) for c in clades], dtype=np.intp)
+
+    @classmethod
+    def from_composites(cls, composites: list[WorldComposite]) -> PopulationMatrix:
+        clades = []
+        columns = {}
+        entries = ([], [], [])
+        for row, composite in enumerate(composites):
+            for species in composite.species:
+                key = clade_key(species.clade)
+                if (column := columns.get(key)) is None:
+                    column = columns[key] = len(clades)
+                    clades.append(species.clade)
+
+                entries[0].append(row)
+                entries[1].append(column)
+                entries[2].append(species.population)
+
+        return cls([c.time for c in composites], clades, *entries)
+
+    def __len__(self):
+        return len(self.populations)
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return len(self.times), len(self.clades)
+
+    def _nearest_ancestor(self, clade: Clade) -> int:
+        base_id, lineage = clade_key(clade)
+        for length in range(len(lineage) - 1, -1, -1):
+            if (column := self._columns.get((base_id, lineage[:length]))) is not None:
+                return column
+        return -1
+
+    def column(self, clade: Clade or str) -> int:
+        if not isinstance(clade, Clade):
+            clade = Clade(clade)
+        return self._columns[clade_key(clade)]
+
+    def descendant_columns(self, clade: Clade or str) -> np.ndarray:
+        column = self.column(clade)
+        return self._order[self._position[column]:self._subtree_end[column]]
+
+    def series(self, clade: Clade or str, descendants=False) -> np.ndarray:
+        column = self.column(clade)
+        if descendants:
+            positions = self._position[self.columns]
+            mask = (positions >= self._position[column]) & (positions < self._subtree_end[column])
+        else:
+            mask = self.columns == column
+
+        totals = np.bincount(self.rows[mask], weights=self.populations[mask], minlength=len(self.times))
+        return totals.astype(np.int64)
+
+    def dense(self, descendants=False) -> np.ndarray:
+        matrix = np.zeros(self.shape, dtype=np.int64)
+        np.add.at(matrix, (self.rows, self.columns), self.populations)
+
+        if descendants:
+            # A running total along the subtree order turns every clade's descendant total into one subtraction.
+            totals = np.zeros((len(self.times), len(self.clades) + 1), dtype=np.int64)
+            np.cumsum(matrix[:, self._order], axis=1, out=totals[:, 1:])
+            matrix = totals[:, self._subtree_end] - totals[:, self._position]
+
+        return matrix
+
+    def included(self, parents: list[int] or np.ndarray, threshold: int) -> np.ndarray:
+        parents = np.asarray(parents, dtype=np.intp)
+        if len(parents) != len(self):
+            raise ValueError(f"Expected {len(self)} nodes, got {len(parents)}.")
+
+        included = self.populations >= threshold
+
+        # Each pass moves every node's population one generation up its lineage and sums it there, so after k passes
+        # a node holds the total population of its descendants k generations down. Only nodes that still have
+        # descendants that far down take part in the next pass.
+        nodes = np.arange(len(parents))
+        totals = self.populations
+        while True:
+            up = parents[nodes]
+            has_parent = up != -1
+            if not has_parent.any():
+                break
+
+            nodes, inverse = np.unique(up[has_parent], return_inverse=True)
+            totals = np.bincount(inverse, weights=totals[has_parent])
+            included[nodes] |= totals >= threshold
+
+        # A species is also kept when the same clade was kept a generation earlier. Jumping pointers up each run of a
+        # clade carries that down a whole run in a logarithmic number of passes.
+        has_parent = parents != -1
+        up = np.where(has_parent, parents, np.arange(len(parents)))
+        up = np.where(has_parent & (self.columns == self.columns[up]), up, np.arange(len(parents)))
+        while True:
+            included |= included[up]
+            jumped = up[up]
+            if np.array_equal(jumped, up):
+                break
+            up = jumped
+
+        return included
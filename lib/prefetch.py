@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import queue
+import threading
+from collections.abc import Iterator
+from pathlib import Path
+
+from .profiling import span
+
+
+class Prefetcher:
+    def __init__(self, files: list[Path], window: int):
+        self.files: list[Path] = [Path(f) for f in files]
+        self.window: int = window
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max(window, 1))
+        self._stopped: threading.Event = threading.Event()
+        self._thread: threading.Thread or None = None
+
+    def __enter__(self) -> Prefetcher:
+        if self.window > 0 and self.files:
+            self._thread = threading.Thread(target=self._read_ahead, name="prefetch", daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def _read(path: Path) -> bytes:
+        with span("reading", file=path.name):
+            return path.read_bytes()
+
+    def _put(self, item: tuple):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _read_ahead(self):
+        # The queue only holds window files at a time, so the reader stays at most that far ahead of the parsers.
+        for path in self.files:
+            if self._stopped.is_set():
+                return
+
+            try:
+                item = (path, self._read(path), None)
+            except Exception as exception:
+                self._put((path, None, exception))
+                return
+
+            self._put(item)
+
+    def __iter__(self) -> Iterator[tuple[Path, bytes or None]]:
+        if self._thread is None:
+            # Without a window each loader reads its own file when it gets to it, which lets saves be streamed.
+            for path in self.files:
+                yield path, None
+            return
+
+        for _ in self.files:
+            path, data, exception = self._queue.get()
+            if exception is not None:
+                raise exception
+            yield path, data
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+
+FORMATS = ("json", "chrome")
+
+ALL_PHASES = "all"
+
+
+class SpanRecord:
+    def __init__(self, name: str, depth: int, args: dict):
+        self.name: str = name
+        self.depth: int = depth
+        self.args: dict = args
+        self.thread: int = threading.get_ident()
+
+        self.start: float = 0.0
+        self.wall_time: float = 0.0
+        self.cpu_time: float = 0.0
+        self.allocated_blocks: int = 0
+        self.peak_memory: int or None = None
+
+        self._peak_floor: int = 0
+
+    def to_data_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "depth": self.depth,
+            "thread": self.thread,
+            "start": self.start,
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+            "allocated_blocks": self.allocated_blocks,
+            "peak_memory": self.peak_memory,
+            "args": self.args
+        }
+
+    def to_trace_event(self, origin: float) -> dict:
+        args = {
+            "cpu_time": self.cpu_time,
+            "allocated_blocks": self.allocated_blocks,
+            **self.args
+        }
+        if self.peak_memory is not None:
+            args["peak_memory"] = self.peak_memory
+
+        return {
+            "name": self.name,
+            "cat": "phase",
+            "ph": "X",
+            "ts": (self.start - origin) * 1e6,
+            "dur": self.wall_time * 1e6,
+            "pid": os.getpid(),
+            "tid": self.thread,
+            "args": args
+        }
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled: bool = False
+        self.memory: bool = False
+        self.cprofile_phases: set[str] = set()
+
+        self._records: list[SpanRecord] = []
+        self._open: list[SpanRecord] = []
+        self._profiles: dict[str, list[cProfile.Profile]] = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._origin: float = time.perf_counter()
+
+    def configure(self, enabled: bool, memory: bool = False, cprofile_phases: str = ""):
+        self.enabled = enabled
+        self.memory = enabled and memory
+        self.cprofile_phases = {p.strip() for p in cprofile_phases.split(",") if p.strip()}
+
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _stack(self) -> list[SpanRecord]:
+        if (stack := getattr(self._local, "stack", None)) is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _wants_cprofile(self, name: str) -> bool:
+        if not self.cprofile_phases:
+            return False
+
+        if getattr(self._local, "cprofile_active", False):
+            return False
+
+        return ALL_PHASES in self.cprofile_phases or name in self.cprofile_phases
+
+    @contextmanager
+    def span(self, name: str, **args):
+        if not self.enabled:
+            yield None
+            return
+
+        stack = self._stack()
+        record = SpanRecord(name, len(stack), args)
+        stack.append(record)
+
+        profile = None
+        if self._wants_cprofile(name):
+            profile = cProfile.Profile()
+            self._local.cprofile_active = True
+
+        memory = self.memory and tracemalloc.is_tracing()
+        if memory:
+            # The peak is shared by every thread, so resetting it hides it from every span still open, not just the
+            # enclosing one. Each of them is handed what it has seen so far first.
+            with self._lock:
+                peak = tracemalloc.get_traced_memory()[1]
+                for other in self._open:
+                    other._peak_floor = max(other._peak_floor, peak)
+                tracemalloc.reset_peak()
+                self._open.append(record)
+
+        blocks = sys.getallocatedblocks()
+        # Only this thread's CPU time is counted, so the prefetch thread and encoder pool don't inflate the span.
+        cpu = time.thread_time()
+        record.start = time.perf_counter()
+
+        if profile is not None:
+            profile.enable()
+
+        try:
+            yield record
+        finally:
+            if profile is not None:
+                profile.disable()
+                self._local.cprofile_active = False
+                with self._lock:
+                    self._profiles.setdefault(name, []).append(profile)
+
+            record.wall_time = time.perf_counter() - record.start
+            record.cpu_time = time.thread_time() - cpu
+            record.allocated_blocks = sys.getallocatedblocks() - blocks
+
+            if memory:
+                with self._lock:
+                    record.peak_memory = max(tracemalloc.get_traced_memory()[1], record._peak_floor)
+                    self._open.remove(record)
+
+            stack.pop()
+            with self._lock:
+                self._records.append(record)
+
+    @property
+    def records(self) -> list[SpanRecord]:
+        with self._lock:
+            return sorted(self._records, key=lambda r: r.start)
+
+    def summary(self) -> dict[str, dict]:
+        phases = {}
+        for record in self.records:
+            phase = phases.setdefault(record.name, {
+                "count": 0,
+                "wall_time": 0.0,
+                "cpu_time": 0.0,
+                "allocated_blocks": 0,
+                "peak_memory": None
+            })
+            phase["count"] += 1
+            phase["wall_time"] += record.wall_time
+            phase["cpu_time"] += record.cpu_time
+            phase["allocated_blocks"] += record.allocated_blocks
+            if record.peak_memory is not None:
+                phase["peak_memory"] = max(phase["peak_memory"] or 0, record.peak_memory)
+        return phases
+
+    def to_data_dict(self) -> dict:
+        return {
+            "summary": self.summary(),
+            "spans": [r.to_data_dict() for r in self.records]
+        }
+
+    def to_chrome_trace(self) -> dict:
+        return {
+            "traceEvents": [r.to_trace_event(self._origin) for r in self.records],
+            "displayTimeUnit": "ms"
+        }
+
+    def dump(self, directory: Path, fmt: str = "json") -> list[Path]:
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown profile format {fmt!r}")
+
+        directory = Path(directory)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        written = []
+
+        prefix = "profile" if fmt == "json" else "trace"
+        path = directory / f"{prefix}-{stamp}.json"
+        with path.open('w') as file:
+            json.dump(self.to_data_dict() if fmt == "json" else self.to_chrome_trace(), file, indent=1)
+        written.append(path)
+
+        with self._lock:
+            profiles = {name: list(p) for name, p in self._profiles.items()}
+        for name, phase_profiles in profiles.items():
+            stats = pstats.Stats(phase_profiles[0])
+            for profile in phase_profiles[1:]:
+                stats.add(profile)
+            stats_path = directory / f"profile-{stamp}-{name}.prof"
+            stats.dump_stats(stats_path)
+            written.append(stats_path)
+
+        return written
+
+    def reset(self):
+        with self._lock:
+            self._records = []
+            self._profiles = {}
+        self._origin = time.perf_counter()
+
+
+profiler = Profiler()
+
+
+def span(name: str, **args):
+    return profiler.span(name, **args)
@@ -0,0 +1,398 @@
+from __future__ import annotations
+
+import math
+from pathlib import Path
+
+from PIL import ImageDraw, Image
+
+from .color import Color
+from .config import Settings
+from .encode import new_image, palette_for, save_image, uses_palette
+from .profiling import span
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .datamodel import Organism
+
+
+class CladeDraw(ImageDraw.ImageDraw):
+    def __init__(self, image: Image.Image, settings: Settings, mode=None):
+        super().__init__(image, mode)
+        self.settings: Settings = settings
+
+    def flush(self, batch: DrawBatch):
+        # Inks are resolved once per color and every primitive goes straight to the C drawing core, skipping the
+        # per-call argument handling of ImageDraw.line and ImageDraw.ellipse.
+        core = self.draw
+        draw_lines = core.draw_lines
+        draw_ellipse = core.draw_ellipse
+
+        def getink(rgb: tuple[int, int, int]) -> int:
+            return self._getink(rgb)[0]
+
+        for layer in _LAYERS:
+            for (rgb, width), polylines in batch.lines[layer].items():
+                ink = getink(rgb)
+                for xy in polylines:
+                    draw_lines(xy, ink, width)
+
+            if layer == CIRCLES and batch.ellipses:
+                settings = self.settings
+                fill = getink((0, 0, 0))
+                outline = getink(settings.diagram_line_color.rgb)
+                width = settings.diagram_line_thickness
+                for bbox in batch.ellipses:
+                    draw_ellipse(bbox, fill, 1)
+                    if outline != fill:
+                        draw_ellipse(bbox, outline, 0, width)
+
+            if layer == CIRCLES:
+                for rgb, boxes in batch.dots.items():
+                    ink = getink(rgb)
+                    for bbox in boxes:
+                        draw_ellipse(bbox, ink, 1)
+
+            if layer == ORGANISMS:
+                inks = {}
+                for rgb, xy in batch.segments:
+                    if (ink := inks.get(rgb)) is None:
+                        ink = inks[rgb] = getink(rgb)
+                    draw_lines(xy, ink, 1)
+
+
+class Renderer:
+    def __init__(self, size: tuple[int, int], settings: Settings):
+        self.size: tuple[int, int] = size
+        self.settings: Settings = settings
+
+    def __enter__(self) -> Renderer:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.finish()
+        finally:
+            self.close()
+
+    def generation_line(self, y: float):
+        raise NotImplementedError()
+
+    def connector(self, start: tuple[int, int], end: tuple[int, int], midrange: int):
+        raise NotImplementedError()
+
+    def circle(self, xy: tuple[int, int], radius: float):
+        raise NotImplementedError()
+
+    def organism(self, xy: tuple[int, int], organism: Organism, scale: float = 1.0):
+        raise NotImplementedError()
+
+    def dot(self, xy: tuple[int, int], radius: float, rgb: tuple[int, int, int]):
+        raise NotImplementedError()
+
+    def finish(self):
+        pass
+
+    def close(self):
+        pass
+
+
+GENERATION_LINES = 0
+CONNECTORS = 1
+CIRCLES = 2
+ORGANISMS = 3
+
+_LAYERS = (GENERATION_LINES, CONNECTORS, CIRCLES, ORGANISMS)
+
+
+class DrawBatch:
+    def __init__(self):
+        self.lines: list[dict[tuple[tuple[int, int, int], int], list[tuple]]] = [{} for _ in _LAYERS]
+        self.ellipses: list[tuple[int, int, int, int]] = []
+        self.dots: dict[tuple[int, int, int], list[tuple[int, int, int, int]]] = {}
+        # Organism segments keep their drawing order, since segments of different colors cross inside a glyph.
+        self.segments: list[tuple[tuple[int, int, int], tuple]] = []
+
+        self._glyphs: dict[tuple[int, float], tuple[Organism, list[tuple[tuple[int, int, int], tuple]]]] = {}
+
+    def __len__(self):
+        return sum(len(p) for layer in self.lines for p in layer.values()) + len(self.ellipses) + len(self.segments) \
+            + sum(len(d) for d in self.dots.values())
+
+    def line(self, layer: int, xy: tuple, rgb: tuple[int, int, int], width: int):
+        self.lines[layer].setdefault((rgb, width), []).append(xy)
+
+    def ellipse(self, bbox: tuple[int, int, int, int]):
+        self.ellipses.append(bbox)
+
+    def dot(self, bbox: tuple[int, int, int, int], rgb: tuple[int, int, int]):
+        self.dots.setdefault(rgb, []).append(bbox)
+
+    def _glyph(self, organism: Organism, scale: float) -> list[tuple[tuple[int, int, int], tuple]]:
+        # Keeping the organism alongside its glyph stops its id from being reused while the batch is alive.
+        if (glyph := self._glyphs.get((id(organism), scale))) is None:
+            segments = [(s.color.rgb, (*s.origin, *s.destination)) for s in organism.segment_tree.segments()]
+            if scale != 1:
+                segments = [(rgb, tuple(round(v * scale) for v in xy)) for rgb, xy in segments]
+            glyph = self._glyphs[(id(organism), scale)] = (organism, segments)
+        return glyph[1]
+
+    def colors(self) -> set[tuple[int, int, int]]:
+        colors = {rgb for layer in self.lines for rgb, _ in layer}
+        colors.update(rgb for rgb, _ in self.segments)
+        colors.update(self.dots)
+        return colors
+
+    def organism(self, xy: tuple[int, int], organism: Organism, scale: float = 1.0):
+        x, y = xy
+        self.segments.extend((rgb, (x1 + x, y1 + y, x2 + x, y2 + y))
+                             for rgb, (x1, y1, x2, y2) in self._glyph(organism, scale))
+
+
+class PillowRenderer(Renderer):
+    def __init__(self, path: Path or None, size: tuple[int, int], settings: Settings,
+                 palette: list[tuple[int, int, int]] or None = None):
+        super().__init__(size, settings)
+        self.path: Path or None = None if path is None else Path(path)
+        self.palette: list[tuple[int, int, int]] or None = palette
+        self.batch: DrawBatch = DrawBatch()
+
+        self._line_rgb: tuple[int, int, int] = settings.diagram_line_color.rgb
+        self._line_thickness: int = settings.diagram_line_thickness
+
+    def generation_line(self, y: float):
+        settings = self.settings
+        self.batch.line(GENERATION_LINES, (0, y, self.size[0], y), settings.generation_line_color.rgb,
+                        settings.generation_line_thickness)
+
+    def connector(self, start: tuple[int, int], end: tuple[int, int], midrange: int):
+        xy = (start[0], start[1], start[0], midrange, end[0], midrange, end[0], end[1])
+        self.batch.line(CONNECTORS, xy, self._line_rgb, self._line_thickness)
+
+    def circle(self, xy: tuple[int, int], radius: float):
+        self.batch.ellipse((round(xy[0] - radius), round(xy[1] - radius), round(xy[0] + radius), round(xy[1] + radius)))
+
+    def organism(self, xy: tuple[int, int], organism: Organism, scale: float = 1.0):
+        self.batch.organism(xy, organism, scale)
+
+    def dot(self, xy: tuple[int, int], radius: float, rgb: tuple[int, int, int]):
+        bbox = (round(xy[0] - radius), round(xy[1] - radius), round(xy[0] + radius), round(xy[1] + radius))
+        self.batch.dot(bbox, rgb)
+
+    def rasterize(self, image: Image.Image or None = None) -> Image.Image:
+        # Drawing onto an existing image lays the batch over whatever is already there.
+        if image is None:
+            palette = self.palette
+            if palette is None and self.path is not None and uses_palette(self.path, self.settings):
+                # Drawing straight into a paletted image needs a third of the memory and encodes faster.
+                palette = palette_for(self.batch.colors() | {(0, 0, 0), self._line_rgb})
+
+            size = self.size
+            with span("allocation", width=size[0], height=size[1]):
+                image = new_image(size, palette)
+
+        with span("rasterizing", primitives=len(self.batch)):
+            CladeDraw(image, self.settings).flush(self.batch)
+        self.batch = DrawBatch()
+
+        return image
+
+    def finish(self):
+        image = self.rasterize()
+        with span("encoding", file=self.path.name):
+            save_image(image, self.path, self.settings)
+
+
+def _svg_number(value: float) -> str:
+    return f"{value:.2f}".rstrip("0").rstrip(".")
+
+
+def _svg_points(xy) -> str:
+    return " ".join(f"{_svg_number(x)},{_svg_number(y)}" for x, y in xy)
+
+
+class SvgRenderer(Renderer):
+    def __init__(self, path: Path, size: tuple[int, int], settings: Settings):
+        super().__init__(size, settings)
+        self.path: Path = Path(path)
+
+        self._glyphs: dict[tuple, str] = {}
+        self._file = self.path.open('w', buffering=2 ** 20)
+
+        width, height = size
+        line_color = settings.diagram_line_color.html
+        line_thickness = settings.diagram_line_thickness
+        self._file.write(
+            f'<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+            f'width="{width}" height="{height}" viewBox="0 0 {width} {height}">\n'
+            f'<style>'
+            f'.c{{fill:none;stroke:{line_color};stroke-width:{line_thickness}}}'
+            f'.n{{fill:#000000;stroke:{line_color};stroke-width:{line_thickness}}}'
+            f'.g{{stroke:{settings.generation_line_color.html};stroke-width:{settings.generation_line_thickness}}}'
+            f'.o line{{stroke-width:1}}'
+            f'</style>\n'
+            f'<rect width="{width}" height="{height}" fill="#000000"/>\n'
+        )
+
+    def generation_line(self, y: float):
+        y = _svg_number(y)
+        self._file.write(f'<line class="g" x1="0" y1="{y}" x2="{self.size[0]}" y2="{y}"/>\n')
+
+    def connector(self, start: tuple[int, int], end: tuple[int, int], midrange: int):
+        xy = (
+            start,
+            (start[0], midrange),
+            (end[0], midrange),
+            end
+        )
+        self._file.write(f'<polyline class="c" points="{_svg_points(xy)}"/>\n')
+
+    def circle(self, xy: tuple[int, int], radius: float):
+        # Pillow draws the outline inside the bounding box, whereas SVG centers the stroke on the path.
+        radius = max(round(radius) - self.settings.diagram_line_thickness / 2, 0)
+        self._file.write(f'<circle class="n" cx="{_svg_number(xy[0])}" cy="{_svg_number(xy[1])}" '
+                         f'r="{_svg_number(radius)}"/>\n')
+
+    def _glyph(self, organism: Organism) -> str:
+        segments = tuple((segment.xy(), segment.color.rgb) for segment in organism.segment_tree.segments())
+
+        if (glyph_id := self._glyphs.get(segments)) is not None:
+            return glyph_id
+
+        glyph_id = self._glyphs[segments] = f"o{len(self._glyphs)}"
+
+        lines = "".join(
+            f'<line x1="{_svg_number(start[0])}" y1="{_svg_number(start[1])}" '
+            f'x2="{_svg_number(end[0])}" y2="{_svg_number(end[1])}" stroke="{Color(rgb).html}"/>'
+            for (start, end), rgb in segments
+        )
+        self._file.write(f'<defs><g id="{glyph_id}" class="o">{lines}</g></defs>\n')
+
+        return glyph_id
+
+    def organism(self, xy: tuple[int, int], organism: Organism, scale: float = 1.0):
+        glyph_id = self._glyph(organism)
+        if scale != 1:
+            self._file.write(f'<use xlink:href="#{glyph_id}" transform="translate({_svg_number(xy[0])} '
+                             f'{_svg_number(xy[1])}) scale({_svg_number(scale)})"/>\n')
+            return
+        self._file.write(f'<use xlink:href="#{glyph_id}" x="{_svg_number(xy[0])}" y="{_svg_number(xy[1])}"/>\n')
+
+    def dot(self, xy: tuple[int, int], radius: float, rgb: tuple[int, int, int]):
+        self._file.write(f'<circle cx="{_svg_number(xy[0])}" cy="{_svg_number(xy[1])}" r="{_svg_number(radius)}" '
+                         f'fill="{Color(rgb).html}"/>\n')
+
+    def finish(self):
+        self._file.write('</svg>\n')
+
+    def close(self):
+        self._file.close()
+
+
+class DrawList(Renderer):
+    def __init__(self, size: tuple[int, int], settings: Settings):
+        super().__init__(size, settings)
+
+        self.commands: list[tuple[str, tuple]] = []
+        self.bounds: list[tuple[float, float, float, float]] = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def _add(self, bounds: tuple[float, float, float, float], method: str, *args):
+        self.commands.append((method, args))
+        self.bounds.append(bounds)
+
+    def generation_line(self, y: float):
+        thickness = self.settings.generation_line_thickness
+        self._add((0, y - thickness, self.size[0], y + thickness), "generation_line", y)
+
+    def connector(self, start: tuple[int, int], end: tuple[int, int], midrange: int):
+        thickness = self.settings.diagram_line_thickness
+        bounds = (
+            min(start[0], end[0]) - thickness,
+            min(start[1], end[1], midrange) - thickness,
+            max(start[0], end[0]) + thickness,
+            max(start[1], end[1], midrange) + thickness
+        )
+        self._add(bounds, "connector", start, end, midrange)
+
+    def circle(self, xy: tuple[int, int], radius: float):
+        extent = radius + 1
+        self._add((xy[0] - extent, xy[1] - extent, xy[0] + extent, xy[1] + extent), "circle", xy, radius)
+
+    def organism(self, xy: tuple[int, int], organism: Organism, scale: float = 1.0):
+        left, top, right, bottom = (v * scale for v in organism.bounds)
+        self._add((xy[0] + left - 1, xy[1] + top - 1, xy[0] + right + 1, xy[1] + bottom + 1), "organism", xy, organism,
+                  scale)
+
+    def dot(self, xy: tuple[int, int], radius: float, rgb: tuple[int, int, int]):
+        extent = radius + 1
+        self._add((xy[0] - extent, xy[1] - extent, xy[0] + extent, xy[1] + extent), "dot", xy, radius, rgb)
+
+    def colors(self) -> set[tuple[int, int, int]]:
+        settings = self.settings
+        colors = {(0, 0, 0), settings.diagram_line_color.rgb}
+        organisms = {}
+        for method, args in self.commands:
+            if method == "generation_line":
+                colors.add(settings.generation_line_color.rgb)
+            elif method == "organism":
+                organisms[id(args[1])] = args[1]
+            elif method == "dot":
+                colors.add(args[2])
+
+        for organism in organisms.values():
+            colors.update(s.color.rgb for s in organism.segment_tree.segments())
+        return colors
+
+    def strip_index(self, strip_height: int) -> dict[int, list[int]]:
+        strips = {}
+        count = math.ceil(self.size[1] / strip_height)
+        for i, (_, top, _, bottom) in enumerate(self.bounds):
+            for row in range(max(int(top // strip_height), 0), min(int(bottom // strip_height), count - 1) + 1):
+                strips.setdefault(row, []).append(i)
+        return strips
+
+    def grid_index(self, cell_size: int) -> dict[tuple[int, int], list[int]]:
+        cells = {}
+        columns = math.ceil(self.size[0] / cell_size)
+        rows = math.ceil(self.size[1] / cell_size)
+        for i, (left, top, right, bottom) in enumerate(self.bounds):
+            first_column = max(int(left // cell_size), 0)
+            last_column = min(int(right // cell_size), columns - 1)
+            first_row = max(int(top // cell_size), 0)
+            last_row = min(int(bottom // cell_size), rows - 1)
+            for column in range(first_column, last_column + 1):
+                for row in range(first_row, last_row + 1):
+                    cells.setdefault((column, row), []).append(i)
+        return cells
+
+    def replay(self, renderer: Renderer, offset: tuple[int, int] = (0, 0), indices: list[int] or None = None):
+        dx, dy = offset
+        commands = self.commands if indices is None else (self.commands[i] for i in indices)
+        for method, args in commands:
+            match method:
+                case "generation_line":
+                    renderer.generation_line(args[0] - dy)
+                case "connector":
+                    start, end, midrange = args
+                    renderer.connector((start[0] - dx, start[1] - dy), (end[0] - dx, end[1] - dy), midrange - dy)
+                case "circle":
+                    xy, radius = args
+                    renderer.circle((xy[0] - dx, xy[1] - dy), radius)
+                case "organism":
+                    xy, organism, scale = args
+                    renderer.organism((xy[0] - dx, xy[1] - dy), organism, scale)
+                case "dot":
+                    xy, radius, rgb = args
+                    renderer.dot((xy[0] - dx, xy[1] - dy), radius, rgb)
+
+
+RENDERERS: dict[str, type[Renderer]] = {
+    "svg": SvgRenderer
+}
+
+
+def renderer_for(file_type: str) -> type[Renderer]:
+    return RENDERERS.get(file_type.lower(), PillowRenderer)
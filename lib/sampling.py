@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+from collections.abc import Callable
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .composite import WorldComposite
+
+
+SAMPLING_MODES = ("all", "nth", "time", "adaptive")
+
+
+def every_nth(count: int, interval: int) -> list[int]:
+    indices = list(range(0, count, max(interval, 1)))
+    if indices and indices[-1] != count - 1:
+        indices.append(count - 1)
+    return indices
+
+
+def time_spaced(times: list[int or None], spacing: int) -> list[int]:
+    kept = []
+    last = None
+    for i, time in enumerate(times):
+        # Checkpoints whose time can't be told without reading them are always kept.
+        if time is None or last is None or time - last >= spacing or i == len(times) - 1:
+            kept.append(i)
+            if time is not None:
+                last = time
+    return kept
+
+
+def clade_signature(composite: WorldComposite, threshold: int) -> frozenset[str]:
+    return frozenset(c for c, s in composite.species_index.dict.items() if s.population >= threshold)
+
+
+def adaptive(count: int, interval: int, threshold: int,
+             load: Callable[[list[int]], list[WorldComposite]]) -> dict[int, WorldComposite]:
+    composites = {}
+    signatures = {}
+
+    def fetch(indices: list[int]):
+        for i, composite in zip(indices, load(indices)):
+            composites[i] = composite
+            signatures[i] = clade_signature(composite, threshold)
+
+    grid = every_nth(count, interval)
+    fetch(grid)
+
+    # Bisect every gap whose ends disagree on which clades are alive, until the change is pinned to adjacent
+    # checkpoints. Gaps whose ends agree are assumed to be quiet and are never read.
+    gaps = list(zip(grid, grid[1:]))
+    while gaps:
+        gaps = [(a, b) for a, b in gaps if b - a > 1 and signatures[a] != signatures[b]]
+        midpoints = [(a + b) // 2 for a, b in gaps]
+        fetch(midpoints)
+        gaps = [gap for (a, b), m in zip(gaps, midpoints) for gap in ((a, m), (m, b))]
+
+    return composites
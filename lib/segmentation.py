@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import math
+
+from .config import Settings
+from .encode import PALETTE_FORMATS
+from .layout import Layout
+
+
+BYTES_PER_PIXEL = 3
+PALETTE_BYTES_PER_PIXEL = 1
+
+
+def bytes_per_pixel(settings: Settings) -> int:
+    # Paletted images are only used when a diagram has 256 colors or fewer, which can't be known before it is drawn.
+    # The diagrams are drawn from a handful of colors, so a paletted image is assumed whenever one can be used.
+    if settings.palette_quantize and settings.file_type.lower() in PALETTE_FORMATS:
+        return PALETTE_BYTES_PER_PIXEL
+    return BYTES_PER_PIXEL
+
+
+def pixel_budget(settings: Settings) -> int or None:
+    budgets = []
+    if settings.clade_split_max_megapixels != -1:
+        budgets.append(settings.clade_split_max_megapixels * 1_000_000)
+    if settings.clade_split_max_megabytes != -1:
+        budgets.append(settings.clade_split_max_megabytes * 1_000_000 / bytes_per_pixel(settings))
+
+    return math.floor(min(budgets)) if budgets else None
+
+
+def interval_segments(generation_count: int, interval: int) -> list[tuple[int, int]]:
+    return [(start, min(start + interval, generation_count)) for start in range(0, generation_count, interval)]
+
+
+def plan_segments(layout: Layout, budget: int) -> list[tuple[int, int]]:
+    count = layout.generation_count
+    rows = layout.rows
+    margin = layout.settings.edge_margin
+    segments = []
+
+    start = 0
+    while start < count:
+        bottom = rows[start].bottom + margin
+        width = rows[start].width
+        end = start + 1
+
+        # The layout is shared by every segment, so each viewport's size is known exactly without drawing anything.
+        while end < count:
+            next_width = max(width, rows[end].width)
+            if next_width * (bottom - (rows[end].top - margin)) > budget:
+                break
+            width = next_width
+            end += 1
+
+        if (pixels := width * (bottom - (rows[end - 1].top - margin))) > budget:
+            print(f"Warning: Generation {start + 1} alone needs about {pixels / 1_000_000:.1f} megapixels, "
+                  f"which is over the split budget.")
+
+        segments.append((start, end))
+        start = end
+
+    return segments
@@ -87,3 +87,10 @@ class SegmentTree:
     @cached_property
     def radius(self) -> float:
         return max(self.root.distance(s.destination) for s in self.segments())
+
+    @cached_property
+    def bounds(self) -> tuple[float, float, float, float]:
+        points = [self.root, *(s.destination for s in self.segments())]
+        xs = [p.x for p in points]
+        ys = [p.y for p in points]
+        return (min(xs), min(ys), max(xs), max(ys))
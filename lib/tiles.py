@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import json
+import math
+from pathlib import Path
+
+from PIL import Image
+
+from . import paths
+from .config import Settings
+from .encode import save_image
+from .profiling import span
+from .render import DrawList, PillowRenderer
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .layout import Layout
+
+
+TILE_FORMAT = "png"
+
+VIEWER_NAME = "index.html"
+
+
+def level_count(size: tuple[int, int], tile_size: int) -> int:
+    return max(math.ceil(math.log2(max(size) / tile_size)), 0) + 1
+
+
+def tile_path(directory: Path, level: int, column: int, row: int) -> Path:
+    return directory / str(level) / f"{column}_{row}.{TILE_FORMAT}"
+
+
+def _render_full_level(draw_list: DrawList, directory: Path, level: int, settings: Settings) -> set[tuple[int, int]]:
+    tile_size = settings.tile_size
+    cells = draw_list.grid_index(tile_size)
+    (directory / str(level)).mkdir(parents=True, exist_ok=True)
+
+    cells_count = len(cells)
+    for i, ((column, row), indices) in enumerate(sorted(cells.items())):
+        if i % 100 == 0:
+            print(f"Drawing tiles... ({i}/{cells_count})")
+
+        with PillowRenderer(tile_path(directory, level, column, row), (tile_size, tile_size), settings) as renderer:
+            draw_list.replay(renderer, (column * tile_size, row * tile_size), indices)
+
+    return set(cells)
+
+
+def _reduce_level(directory: Path, level: int, tiles: set[tuple[int, int]], settings: Settings) -> set[tuple[int, int]]:
+    tile_size = settings.tile_size
+    (directory / str(level - 1)).mkdir(parents=True, exist_ok=True)
+
+    parents = sorted({(column // 2, row // 2) for column, row in tiles})
+    for column, row in parents:
+        canvas = Image.new("RGB", (tile_size * 2, tile_size * 2), (0, 0, 0))
+        for dx in range(2):
+            for dy in range(2):
+                if (child := (column * 2 + dx, row * 2 + dy)) in tiles:
+                    with Image.open(tile_path(directory, level, *child)) as tile:
+                        canvas.paste(tile, (dx * tile_size, dy * tile_size))
+
+        with span("encoding", file=f"{level - 1}/{column}_{row}"):
+            save_image(canvas.reduce(2), tile_path(directory, level - 1, column, row), settings)
+
+    return set(parents)
+
+
+def render_tile_pyramid(layout: Layout, directory: Path) -> Path:
+    settings = layout.settings
+    directory = Path(directory)
+    size = layout.size()
+    levels = level_count(size, settings.tile_size)
+
+    print("Recording diagram...")
+    draw_list = DrawList(size, settings)
+    layout.render(draw_list)
+
+    # The pyramid is built in a directory of its own and swapped in whole, so the previous one stays viewable until
+    # the new one is complete.
+    with paths.replacing(directory, directory=True) as building:
+        print(f"Drawing {levels} tile levels...")
+        with span("tiles", level=levels - 1):
+            tiles = _render_full_level(draw_list, building, levels - 1, settings)
+
+        for level in range(levels - 1, 0, -1):
+            print(f"Reducing tile level {level}...")
+            with span("tiles", level=level - 1):
+                tiles = _reduce_level(building, level, tiles, settings)
+
+        meta = {
+            "width": size[0],
+            "height": size[1],
+            "tileSize": settings.tile_size,
+            "levels": levels,
+            "format": TILE_FORMAT
+        }
+        (building / VIEWER_NAME).write_text(_VIEWER.replace("/*META*/", json.dumps(meta)))
+
+    viewer = directory / VIEWER_NAME
+    print(f"Wrote tile viewer to {viewer.parent.name}/{viewer.name}.")
+
+    return viewer
+
+
+_VIEWER = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Clade Diagram</title>
+<style>
+html, body { margin: 0; height: 100%; overflow: hidden; background: #000; }
+#view { position: absolute; inset: 0; cursor: grab; }
+#view img { position: absolute; image-rendering: auto; user-select: none; -webkit-user-drag: none; }
+</style>
+</head>
+<body>
+<div id="view"></div>
+<script>
+const meta = /*META*/;
+const view = document.getElementById("view");
+const maxLevel = meta.levels - 1;
+const loaded = new Map();
+let scale = Math.min(1, view.clientWidth / meta.width);
+let x = (view.clientWidth - meta.width * scale) / 2;
+let y = 0;
+
+function update() {
+    const level = Math.max(0, Math.min(maxLevel, maxLevel + Math.ceil(Math.log2(scale))));
+    const factor = Math.pow(2, maxLevel - level);
+    const size = meta.tileSize * factor * scale;
+    const columns = Math.ceil(meta.width / factor / meta.tileSize);
+    const rows = Math.ceil(meta.height / factor / meta.tileSize);
+    const first = [Math.max(0, Math.floor(-x / size)), Math.max(0, Math.floor(-y / size))];
+    const last = [Math.min(columns - 1, Math.floor((view.clientWidth - x) / size)),
+                  Math.min(rows - 1, Math.floor((view.clientHeight - y) / size))];
+    const visible = new Set();
+
+    for (let column = first[0]; column <= last[0]; column++) {
+        for (let row = first[1]; row <= last[1]; row++) {
+            const key = `${level}/${column}_${row}`;
+            visible.add(key);
+
+            let img = loaded.get(key);
+            if (img === undefined) {
+                img = document.createElement("img");
+                img.onerror = () => { img.style.visibility = "hidden"; };
+                img.src = `${key}.${meta.format}`;
+                loaded.set(key, img);
+                view.appendChild(img);
+            }
+            img.style.left = `${x + column * size}px`;
+            img.style.top = `${y + row * size}px`;
+            img.style.width = img.style.height = `${size + 0.5}px`;
+        }
+    }
+
+    for (const [key, img] of loaded) {
+        if (!visible.has(key)) {
+            img.remove();
+            loaded.delete(key);
+        }
+    }
+}
+
+view.addEventListener("wheel", event => {
+    event.preventDefault();
+    const factor = Math.pow(1.0015, -event.deltaY);
+    const newScale = Math.min(4, Math.max(Math.pow(2, -maxLevel - 1), scale * factor));
+    x = event.clientX - (event.clientX - x) * newScale / scale;
+    y = event.clientY - (event.clientY - y) * newScale / scale;
+    scale = newScale;
+    update();
+}, { passive: false });
+
+let drag = null;
+view.addEventListener("pointerdown", event => {
+    drag = [event.clientX - x, event.clientY - y];
+    view.setPointerCapture(event.pointerId);
+    view.style.cursor = "grabbing";
+});
+view.addEventListener("pointermove", event => {
+    if (drag !== null) {
+        x = event.clientX - drag[0];
+        y = event.clientY - drag[1];
+        update();
+    }
+});
+view.addEventListener("pointerup", () => { drag = null; view.style.cursor = "grab"; });
+window.addEventListener("resize", update);
+update();
+</script>
+</body>
+</html>
+"""
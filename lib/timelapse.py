@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import math
+from pathlib import Path
+
+from . import paths
+from .config import Settings
+from .encode import ApngWriter, FrameFileWriter, GifWriter, new_image, palette_for
+from .layout import scaled_settings
+from .profiling import span
+from .render import DrawList, PillowRenderer
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .layout import Layout
+
+
+TIMELAPSE_FORMATS = ("gif", "apng", "frames")
+
+
+def _changed_box(draw_list: DrawList, first: int, last: int, size: tuple[int, int]) -> tuple[int, int, int, int]:
+    if first == last:
+        return (0, 0, 1, 1)
+
+    bounds = draw_list.bounds[first:last]
+    left = max(math.floor(min(b[0] for b in bounds)), 0)
+    top = max(math.floor(min(b[1] for b in bounds)), 0)
+    right = min(math.ceil(max(b[2] for b in bounds)) + 1, size[0])
+    bottom = min(math.ceil(max(b[3] for b in bounds)) + 1, size[1])
+    if left >= right or top >= bottom:
+        return (0, 0, 1, 1)
+    return (left, top, right, bottom)
+
+
+def render_timelapse(layout: Layout, directory: Path, settings: Settings) -> Path:
+    scale = settings.timelapse_scale
+    frame_settings = scaled_settings(settings, scale)
+    size = layout.size(scale=scale)
+    frame_count = layout.generation_count
+
+    # The final diagram is recorded once, generation by generation, so each frame only has to replay the commands of
+    # one more generation onto the previous frame.
+    print("Recording timelapse...")
+    draw_list = DrawList(size, frame_settings)
+    boundaries = [0]
+    for _ in layout.render_generations(draw_list, scale):
+        boundaries.append(len(draw_list))
+
+    palette = palette_for(draw_list.colors()) if settings.palette_quantize else None
+
+    match settings.timelapse_format:
+        case "gif":
+            path = directory / "clade-timelapse.gif"
+        case "apng":
+            path = directory / "clade-timelapse.png"
+        case "frames":
+            path = directory / "timelapse"
+        case _:
+            raise ValueError(f"Unknown timelapse_format {settings.timelapse_format}, expected one of "
+                             f"{', '.join(TIMELAPSE_FORMATS)}.")
+
+    duration = settings.timelapse_frame_duration
+
+    print(f"Writing {frame_count} timelapse frames to {path.name}...")
+    with paths.replacing(path, directory=settings.timelapse_format == "frames") as target:
+        match settings.timelapse_format:
+            case "gif":
+                writer = GifWriter(target, size, frame_count, duration, settings)
+            case "apng":
+                writer = ApngWriter(target, size, palette, frame_count, duration, settings)
+            case _:
+                writer = FrameFileWriter(target, settings.file_type, size, frame_count, duration, settings)
+
+        whole = isinstance(writer, FrameFileWriter)
+
+        with span("timelapse", frames=frame_count, width=size[0], height=size[1]), writer:
+            canvas = new_image(size, palette)
+            for frame, (first, last) in enumerate(zip(boundaries, boundaries[1:])):
+                if frame % 10 == 0:
+                    print(f"Drawing timelapse frames... ({frame}/{frame_count})")
+
+                renderer = PillowRenderer(None, size, frame_settings, palette)
+                draw_list.replay(renderer, indices=range(first, last))
+                renderer.rasterize(canvas)
+
+                # Only the region the new generation touched is handed to the encoder, except for the first frame.
+                if whole or frame == 0:
+                    writer.write(canvas.copy())
+                else:
+                    box = _changed_box(draw_list, first, last, size)
+                    writer.write(canvas.crop(box), box[:2])
+
+    print(f"Finished writing {path.name}.")
+
+    return path